@@ -1,21 +1,44 @@
 import logging
 import asyncio
 import time
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
+from aiogram.dispatcher.flags import get_flag
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 import aiohttp
+import aiofiles
 import mysql.connector
-from datetime import datetime, timedelta
+from mysql.connector.aio.pooling import MySQLConnectionPool
+from mysql.connector.errors import PoolError
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 import os
 import random
 import re
+import signal
+import sys
 import smtplib
 from email.message import EmailMessage
 from aiohttp import web
 import hmac
 import hashlib
+from contextvars import ContextVar
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.methods import (
+    SendMessage, SendPhoto, SendVideo, SendDocument, SendMediaGroup,
+    EditMessageText, EditMessageCaption, EditMessageMedia, EditMessageReplyMarkup
+)
+import html
+import json
+import uuid
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -25,17 +48,80 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 JIRA_URL = os.getenv("JIRA_URL")
 BEARER_TOKEN = os.getenv("BEARER_TOKEN")
 JIRA_PROJECT_KEY = os.getenv("JIRA_PROJECT_KEY")
+JIRA_CONNECTION_LIMIT = int(os.getenv("JIRA_CONNECTION_LIMIT", 20))
+JIRA_KEEPALIVE_TIMEOUT = int(os.getenv("JIRA_KEEPALIVE_TIMEOUT", 60))  # секунды простоя keep-alive соединения
+JIRA_DNS_CACHE_TTL = int(os.getenv("JIRA_DNS_CACHE_TTL", 300))
+JIRA_READ_TIMEOUT = float(os.getenv("JIRA_READ_TIMEOUT", 10))  # секунды на GET целиком
+JIRA_WRITE_TIMEOUT = float(os.getenv("JIRA_WRITE_TIMEOUT", 30))  # секунды на создание задачи/комментария
+JIRA_UPLOAD_TIMEOUT = float(os.getenv("JIRA_UPLOAD_TIMEOUT", 300))  # секунды простоя сокета при загрузке вложения
+JIRA_READ_RETRIES = int(os.getenv("JIRA_READ_RETRIES", 2))
+JIRA_HEDGE_DELAY = float(os.getenv("JIRA_HEDGE_DELAY", 0))  # секунды до дублирующего GET, 0 — выключено
+JIRA_BREAKER_THRESHOLD = int(os.getenv("JIRA_BREAKER_THRESHOLD", 5))  # сбоев подряд до размыкания
+JIRA_BREAKER_RECOVERY = float(os.getenv("JIRA_BREAKER_RECOVERY", 30))  # секунды до пробного запроса
+ATTACHMENT_UPLOAD_CONCURRENCY = int(os.getenv("ATTACHMENT_UPLOAD_CONCURRENCY", 4))
+ATTACHMENT_UPLOAD_RETRIES = int(os.getenv("ATTACHMENT_UPLOAD_RETRIES", 2))
+JIRA_PRIORITY_CACHE_TTL = int(os.getenv("JIRA_PRIORITY_CACHE_TTL", 3600))  # секунды
 PHOTOS_DIR = "photos"
+MEDIA_RELAY_MODE = os.getenv("MEDIA_RELAY_MODE", "disk")  # disk | stream
+MEDIA_RELAY_TIMEOUT = int(os.getenv("MEDIA_RELAY_TIMEOUT", 300))  # секунды
+MEDIA_DOWNLOAD_PER_USER = int(os.getenv("MEDIA_DOWNLOAD_PER_USER", 3))
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", 0.5))  # секунды
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 SMTP_SERVER = os.getenv("SMTP_SERVER")
 SMTP_PORT = int(os.getenv("SMTP_PORT"))
 SMTP_USER = os.getenv("SMTP_USER")
 SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+SMTP_BACKEND = os.getenv("SMTP_BACKEND", "smtp")  # smtp | log (письма только пишутся в лог, для тестов)
+SMTP_QUEUE_SIZE = int(os.getenv("SMTP_QUEUE_SIZE", 500))
+SMTP_MAX_RETRIES = int(os.getenv("SMTP_MAX_RETRIES", 3))
+SMTP_IDLE_TIMEOUT = int(os.getenv("SMTP_IDLE_TIMEOUT", 60))  # секунды простоя до закрытия SMTP-соединения
 WEBHOOK_PATH = "/webhook"
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 WEBHOOK_SERVER_HOST = "0.0.0.0"
 WEBHOOK_SERVER_PORT = 1425
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 4))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", 5))  # секунды ожидания места в очереди
+WEBHOOK_QUEUE_PERSIST = os.getenv("WEBHOOK_QUEUE_PERSIST", "false").lower() == "true"
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", 10))  # секунды на обработку принятых событий при остановке
+WEBHOOK_CLAIM_TIMEOUT = int(os.getenv("WEBHOOK_CLAIM_TIMEOUT", 300))  # секунды, после которых события остановившейся реплики забираются снова
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", 5))
+TELEGRAM_UPDATES_MODE = os.getenv("TELEGRAM_UPDATES_MODE", "polling")  # polling | webhook
+TELEGRAM_WEBHOOK_PATH = "/telegram"
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")  # публичный адрес, ведущий на TELEGRAM_WEBHOOK_PATH
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_WEBHOOK_MAX_CONNECTIONS", 40))
+WEBHOOK_ISSUE_STATE_SOURCE = os.getenv("WEBHOOK_ISSUE_STATE_SOURCE", "payload")  # payload | jira
+ISSUE_STATE_CACHE_TTL = int(os.getenv("ISSUE_STATE_CACHE_TTL", 300))  # секунды
+ISSUE_MIRROR_RECONCILE_INTERVAL = int(os.getenv("ISSUE_MIRROR_RECONCILE_INTERVAL", 600))  # секунды
+ISSUE_MIRROR_STALE_AFTER = int(os.getenv("ISSUE_MIRROR_STALE_AFTER", 3600))  # секунды с последней полной сверки
+ISSUE_MIRROR_RECONCILE_BATCH = int(os.getenv("ISSUE_MIRROR_RECONCILE_BATCH", 50))
+ISSUE_MIRROR_RECONCILE_CONCURRENCY = int(os.getenv("ISSUE_MIRROR_RECONCILE_CONCURRENCY", 4))
+ISSUE_MIRROR_STATUS_FRESHNESS = int(os.getenv("ISSUE_MIRROR_STATUS_FRESHNESS", 60))  # секунды, в течение которых статус из зеркала заменяет запрос в Jira перед комментарием
+TICKET_OUTBOX_WORKERS = int(os.getenv("TICKET_OUTBOX_WORKERS", 2))
+TICKET_OUTBOX_MAX_ATTEMPTS = int(os.getenv("TICKET_OUTBOX_MAX_ATTEMPTS", 8))
+TICKET_OUTBOX_POLL_INTERVAL = float(os.getenv("TICKET_OUTBOX_POLL_INTERVAL", 2))  # секунды
+TICKET_OUTBOX_CLAIM_TIMEOUT = int(os.getenv("TICKET_OUTBOX_CLAIM_TIMEOUT", 900))  # секунды, после которых зависшая запись забирается снова
+STATUS_SYNC_INTERVAL = int(os.getenv("STATUS_SYNC_INTERVAL", 300))  # секунды
+STATUS_SYNC_INITIAL_DAYS = int(os.getenv("STATUS_SYNC_INITIAL_DAYS", 90))  # глубина первой сверки
+STATUS_SYNC_PAGE_SIZE = int(os.getenv("STATUS_SYNC_PAGE_SIZE", 100))
+STATUS_SYNC_UPDATE_BATCH = int(os.getenv("STATUS_SYNC_UPDATE_BATCH", 500))
+
+# Ограничения исходящих сообщений Telegram
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 25))  # сообщений в секунду на бота
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))  # сообщений в секунду на чат
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", 5))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", 3))
+NOTIFICATION_DIGEST_WINDOW = float(os.getenv("NOTIFICATION_DIGEST_WINDOW", 10))  # секунды, 0 отключает объединение
+NOTIFICATION_DIGEST_ENTRY_LIMIT = int(os.getenv("NOTIFICATION_DIGEST_ENTRY_LIMIT", 500))  # символов на одно событие в сводке
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Хранение уведомлений
+NOTIFICATIONS_RETENTION_INTERVAL = int(os.getenv("NOTIFICATIONS_RETENTION_INTERVAL", 300))  # секунды между запусками очистки
+NOTIFICATIONS_MAX_PER_USER = int(os.getenv("NOTIFICATIONS_MAX_PER_USER", 100))  # 0 отключает ограничение
+NOTIFICATIONS_MAX_AGE_DAYS = int(os.getenv("NOTIFICATIONS_MAX_AGE_DAYS", 0))  # 0 отключает ограничение
+NOTIFICATIONS_RETENTION_BATCH = int(os.getenv("NOTIFICATIONS_RETENTION_BATCH", 1000))
 
 # MySQL конфигурация
 MYSQL_HOST = os.getenv("MYSQL_HOST")
@@ -43,6 +129,23 @@ MYSQL_PORT = int(os.getenv("MYSQL_PORT", 3306))  # 3306 как значение
 MYSQL_USER = os.getenv("MYSQL_USER")
 MYSQL_PASSWORD = os.getenv("MYSQL_PASSWORD")
 MYSQL_DATABASE = os.getenv("MYSQL_DATABASE")
+MYSQL_POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", 10))
+MYSQL_POOL_ACQUIRE_TIMEOUT = float(os.getenv("MYSQL_POOL_ACQUIRE_TIMEOUT", 10))  # секунды ожидания свободного соединения
+MYSQL_HEALTH_CHECK_INTERVAL = int(os.getenv("MYSQL_HEALTH_CHECK_INTERVAL", 60))
+VERIFIED_CACHE_TTL = int(os.getenv("VERIFIED_CACHE_TTL", 600))  # секунды
+VERIFIED_CACHE_NEGATIVE_TTL = int(os.getenv("VERIFIED_CACHE_NEGATIVE_TTL", 30))
+VERIFIED_CACHE_SIZE = int(os.getenv("VERIFIED_CACHE_SIZE", 10000))
+LIST_COUNT_CACHE_TTL = int(os.getenv("LIST_COUNT_CACHE_TTL", 60))  # секунды
+KEYBOARD_TTL = int(os.getenv("KEYBOARD_TTL", 60))  # секунды, после которых кнопки списка устаревают
+TEAM_CACHE_TTL = int(os.getenv("TEAM_CACHE_TTL", 300))  # секунды
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")  # memory | mysql
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 0.2))  # секунды, 0 — запись сразу (нужно для нескольких реплик без sticky-маршрутизации)
+FSM_TTL = int(os.getenv("FSM_TTL", 86400))  # секунды, брошенные черновики удаляются
+FSM_EXPIRE_INTERVAL = int(os.getenv("FSM_EXPIRE_INTERVAL", 600))  # секунды
+FSM_EXPIRE_BATCH = int(os.getenv("FSM_EXPIRE_BATCH", 1000))
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "false").lower() == "true"  # иначе миграции запускаются отдельно: migrate
+
+METRICS_PATH = "/metrics"
 
 # Категории и их ID для customfield_10857
 CATEGORIES = {
@@ -58,90 +161,772 @@ CATEGORIES = {
 
 # Инициализация бота
 bot = Bot(token=TELEGRAM_BOT_TOKEN)
-dp = Dispatcher()
 
 # Создаем директорию для фото
 os.makedirs(PHOTOS_DIR, exist_ok=True)
 
-# База данных
-def execute_query(query, params=(), fetch=False):
-    try:
-        conn = mysql.connector.connect(
-            host=MYSQL_HOST,
-            user=MYSQL_USER,
-            password=MYSQL_PASSWORD,
-            database=MYSQL_DATABASE,
-            port=MYSQL_PORT
+# === Метрики ===
+class LatencyStats:
+    def __init__(self, size: int = 1000):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def snapshot(self) -> dict:
+        if not self.samples:
+            return {"count": self.count}
+        ordered = sorted(self.samples)
+        def percentile(p):
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 2)
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 2),
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+            "max_ms": round(ordered[-1] * 1000, 2)
+        }
+
+# === База данных ===
+class Database:
+    def __init__(self, pool_size, acquire_timeout, health_check_interval, **config):
+        self.config = config
+        self.pool_size = pool_size
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+        self.pool = None
+        self._slots = asyncio.Semaphore(pool_size)
+        self._in_use = 0
+        self._health_task = None
+        self.pool_wait = LatencyStats()
+        self.query_latency = LatencyStats()
+        self.errors = 0
+        self.health_check_failures = 0
+
+    async def connect(self):
+        # autocommit убирает лишний COMMIT после каждого запроса, а без reset_session возврат соединения
+        # в пул не стоит отдельного обращения к серверу. Транзакции открываются явно (transaction()),
+        # живость соединений поддерживает _health_check_loop
+        self.pool = MySQLConnectionPool(
+            pool_name="ortp_bot", pool_size=self.pool_size, pool_reset_session=False, autocommit=True, **self.config
         )
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        if fetch:
-            result = cursor.fetchall()
-        else:
-            result = None
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return result
-    except mysql.connector.Error as e:
-        logging.error(f"Ошибка MySQL: {e}")
-        raise
-
-# Создаем таблицы
-execute_query('''
-    CREATE TABLE IF NOT EXISTS requests (
-        user_id BIGINT,
-        issue_key VARCHAR(50) PRIMARY KEY,
-        title TEXT,
-        status VARCHAR(50),
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        category VARCHAR(100)
-    )
-''')
-
-execute_query('''
-    CREATE TABLE IF NOT EXISTS team (
-        id INTEGER PRIMARY KEY AUTO_INCREMENT,
-        position VARCHAR(100) NOT NULL,
-        last_name VARCHAR(100) NOT NULL,
-        first_name VARCHAR(100) NOT NULL,
-        middle_name VARCHAR(100) NOT NULL,
-        photo_path TEXT,
-        description TEXT NOT NULL,
-        telegram VARCHAR(255),
-        game VARCHAR(255),
-        pulse VARCHAR(255)
-    )
-''')
+        await self.pool.initialize_pool()
+        self._health_task = asyncio.create_task(self._health_check_loop())
+        logging.info(f"Пул MySQL открыт: {self.pool_size} соединений")
+
+    async def close(self):
+        if self._health_task:
+            self._health_task.cancel()
+        if self.pool:
+            await self.pool.close_pool()
+            self.pool = None
+
+    @asynccontextmanager
+    async def connection(self):
+        # Семафор ограничивает число одновременных клиентов размером пула:
+        # пул mysql-connector не ждёт свободного соединения, а сразу падает с PoolError
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.errors += 1
+            raise PoolError(f"Нет свободного соединения MySQL за {self.acquire_timeout} с")
+        self.pool_wait.observe(time.perf_counter() - started)
+        self._in_use += 1
+        try:
+            cnx = await self.pool.get_connection()
+            try:
+                yield cnx
+            finally:
+                await cnx.close()
+        finally:
+            self._in_use -= 1
+            self._slots.release()
+
+    async def _run(self, query, params, fetch, many=False):
+        async with self.connection() as cnx:
+            started = time.perf_counter()
+            try:
+                cursor = await cnx.cursor()
+                try:
+                    if many:
+                        await cursor.executemany(query, params)
+                    else:
+                        await cursor.execute(query, params)
+                    return await cursor.fetchall() if fetch else (cursor.rowcount, cursor.lastrowid)
+                finally:
+                    await cursor.close()
+            except mysql.connector.Error as e:
+                self.errors += 1
+                logging.error(f"Ошибка MySQL: {e}")
+                raise
+            finally:
+                self.query_latency.observe(time.perf_counter() - started)
+
+    async def fetch(self, query, params=()):
+        return await self._run(query, params, True)
+
+    async def execute(self, query, params=()) -> int:
+        rowcount, _ = await self._run(query, params, False)
+        return rowcount
+
+    async def executemany(self, query, seq_params) -> int:
+        rowcount, _ = await self._run(query, seq_params, False, many=True)
+        return rowcount
+
+    async def insert(self, query, params=()) -> int:
+        _, lastrowid = await self._run(query, params, False)
+        return lastrowid
+
+    # Несколько запросов одной транзакцией на одном соединении: коммит в конце, откат при любой ошибке
+    @asynccontextmanager
+    async def transaction(self):
+        async with self.connection() as cnx:
+            started = time.perf_counter()
+            await cnx.start_transaction()
+            cursor = await cnx.cursor()
+            try:
+                yield cursor
+                await cnx.commit()
+            except BaseException as e:
+                if isinstance(e, mysql.connector.Error):
+                    self.errors += 1
+                    logging.error(f"Ошибка MySQL в транзакции: {e}")
+                await cnx.rollback()
+                raise
+            finally:
+                await cursor.close()
+                self.query_latency.observe(time.perf_counter() - started)
+
+    async def _health_check_loop(self):
+        # Периодически пингуем соединения, чтобы разорванные после простоя переподключались заранее
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            for _ in range(self.pool_size - self._in_use):
+                try:
+                    async with self.connection() as cnx:
+                        await cnx.ping(reconnect=True, attempts=3, delay=1)
+                except Exception as e:
+                    self.health_check_failures += 1
+                    logging.error(f"Проверка соединения MySQL не прошла: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "pool_size": self.pool_size,
+            "in_use": self._in_use,
+            "errors": self.errors,
+            "health_check_failures": self.health_check_failures,
+            "pool_wait": self.pool_wait.snapshot(),
+            "query_latency": self.query_latency.snapshot()
+        }
 
-execute_query('''
-    CREATE TABLE IF NOT EXISTS users (
-        user_id BIGINT PRIMARY KEY,
-        email VARCHAR(255) UNIQUE,
-        is_verified BOOLEAN DEFAULT FALSE
+db = Database(
+    pool_size=MYSQL_POOL_SIZE,
+    acquire_timeout=MYSQL_POOL_ACQUIRE_TIMEOUT,
+    health_check_interval=MYSQL_HEALTH_CHECK_INTERVAL,
+    host=MYSQL_HOST,
+    user=MYSQL_USER,
+    password=MYSQL_PASSWORD,
+    database=MYSQL_DATABASE,
+    port=MYSQL_PORT
+)
+
+# === Миграции схемы ===
+async def ensure_index(table: str, name: str, columns: str):
+    # В MySQL нет CREATE INDEX IF NOT EXISTS, поэтому проверяем через information_schema
+    exists = await db.fetch(
+        'SELECT 1 FROM information_schema.statistics WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s LIMIT 1',
+        (table, name)
     )
-''')
-
-execute_query('''
-    CREATE TABLE IF NOT EXISTS verification_codes (
-        user_id BIGINT PRIMARY KEY,
-        code VARCHAR(10),
-        expires_at DATETIME,
-        last_request_at DATETIME
+    if not exists:
+        await db.execute(f'CREATE INDEX {name} ON {table} ({columns})')
+        logging.info(f"Создан индекс {name} на {table} ({columns})")
+
+async def ensure_column(table: str, name: str, definition: str):
+    exists = await db.fetch(
+        'SELECT 1 FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s LIMIT 1',
+        (table, name)
     )
-''')
-
-execute_query('''
-    CREATE TABLE IF NOT EXISTS notifications (
-        id INTEGER PRIMARY KEY AUTO_INCREMENT,
-        user_id BIGINT,
-        issue_key VARCHAR(50),
-        event_type VARCHAR(50),
-        message_text TEXT,
-        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        is_read BOOLEAN DEFAULT FALSE
+    if not exists:
+        await db.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+        logging.info(f"Добавлена колонка {table}.{name}")
+
+async def _migration_0001_initial_schema():
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS requests (
+            user_id BIGINT,
+            issue_key VARCHAR(50) PRIMARY KEY,
+            title TEXT,
+            status VARCHAR(50),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            category VARCHAR(100)
+        )
+    ''')
+
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS team (
+            id INTEGER PRIMARY KEY AUTO_INCREMENT,
+            position VARCHAR(100) NOT NULL,
+            last_name VARCHAR(100) NOT NULL,
+            first_name VARCHAR(100) NOT NULL,
+            middle_name VARCHAR(100) NOT NULL,
+            photo_path TEXT,
+            description TEXT NOT NULL,
+            telegram VARCHAR(255),
+            game VARCHAR(255),
+            pulse VARCHAR(255)
+        )
+    ''')
+
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            email VARCHAR(255) UNIQUE,
+            is_verified BOOLEAN DEFAULT FALSE
+        )
+    ''')
+
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS verification_codes (
+            user_id BIGINT PRIMARY KEY,
+            code VARCHAR(10),
+            expires_at DATETIME,
+            last_request_at DATETIME
+        )
+    ''')
+
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS webhook_events (
+            id BIGINT PRIMARY KEY AUTO_INCREMENT,
+            payload LONGTEXT NOT NULL,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY AUTO_INCREMENT,
+            user_id BIGINT,
+            issue_key VARCHAR(50),
+            event_type VARCHAR(50),
+            message_text TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_read BOOLEAN DEFAULT FALSE
+        )
+    ''')
+
+async def _migration_0002_notifications_indexes():
+    await ensure_index('notifications', 'idx_notifications_user_time', 'user_id, timestamp')
+    await ensure_index('notifications', 'idx_notifications_time', 'timestamp')
+
+async def _migration_0003_requests_indexes():
+    # "Мои заявки": фильтр по user_id с сортировкой по created_at, подсчёт активных по status.
+    # users.email уже покрыт уникальным индексом, отдельный не нужен
+    await ensure_index('requests', 'idx_requests_user_created', 'user_id, created_at')
+    await ensure_index('requests', 'idx_requests_user_status', 'user_id, status, created_at')
+
+async def _migration_0004_fsm_storage():
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            storage_key VARCHAR(255) PRIMARY KEY,
+            state VARCHAR(255),
+            data MEDIUMTEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await ensure_index("fsm_storage", "idx_fsm_storage_updated", "updated_at")
+
+async def _migration_0005_team_photo_file_id():
+    # file_id фото после первой загрузки в Telegram; photo_file_source — photo_path, из которого он получен
+    await ensure_column("team", "photo_file_id", "VARCHAR(255)")
+    await ensure_column("team", "photo_file_source", "TEXT")
+
+async def _migration_0006_issue_mirror():
+    # created/updated хранятся строками Jira, как их отдаёт API
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS issue_mirror (
+            issue_key VARCHAR(50) PRIMARY KEY,
+            summary TEXT,
+            description TEXT,
+            assignee VARCHAR(255),
+            status VARCHAR(100),
+            priority VARCHAR(100),
+            created VARCHAR(40),
+            updated VARCHAR(40),
+            last_comment TEXT,
+            last_comment_author VARCHAR(255),
+            synced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await ensure_index("issue_mirror", "idx_issue_mirror_synced", "synced_at")
+
+async def _migration_0007_sync_state():
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            name VARCHAR(50) PRIMARY KEY,
+            value VARCHAR(255) NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        )
+    ''')
+
+async def _migration_0008_ticket_outbox():
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS ticket_outbox (
+            id BIGINT PRIMARY KEY AUTO_INCREMENT,
+            idempotency_key VARCHAR(100) NOT NULL UNIQUE,
+            user_id BIGINT NOT NULL,
+            payload MEDIUMTEXT NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            issue_key VARCHAR(50),
+            uploaded TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            claim_token VARCHAR(36),
+            claimed_at DATETIME,
+            next_attempt_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await ensure_index("ticket_outbox", "idx_ticket_outbox_status", "status, next_attempt_at")
+
+async def _migration_0009_webhook_events_claims():
+    # owner — реплика, обрабатывающая событие; claimed_at продлевается, пока она жива
+    await ensure_column("webhook_events", "owner", "VARCHAR(36)")
+    await ensure_column("webhook_events", "claimed_at", "DATETIME")
+    await ensure_column("webhook_events", "attempts", "INTEGER NOT NULL DEFAULT 0")
+    await ensure_index("webhook_events", "idx_webhook_events_owner", "owner, claimed_at")
+
+async def _migration_0010_notification_outbox():
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id BIGINT PRIMARY KEY AUTO_INCREMENT,
+            user_id BIGINT NOT NULL,
+            issue_key VARCHAR(50) NOT NULL,
+            event_type VARCHAR(50) NOT NULL,
+            message_text TEXT NOT NULL,
+            owner VARCHAR(36),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await ensure_index("notification_outbox", "idx_notification_outbox_owner", "owner, created_at")
+
+MIGRATIONS = [
+    (1, "initial_schema", _migration_0001_initial_schema),
+    (2, "notifications_indexes", _migration_0002_notifications_indexes),
+    (3, "requests_indexes", _migration_0003_requests_indexes),
+    (4, "fsm_storage", _migration_0004_fsm_storage),
+    (5, "team_photo_file_id", _migration_0005_team_photo_file_id),
+    (6, "issue_mirror", _migration_0006_issue_mirror),
+    (7, "sync_state", _migration_0007_sync_state),
+    (8, "ticket_outbox", _migration_0008_ticket_outbox),
+    (9, "webhook_events_claims", _migration_0009_webhook_events_claims),
+    (10, "notification_outbox", _migration_0010_notification_outbox),
+]
+
+async def applied_migrations() -> set:
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    rows = await db.fetch('SELECT version FROM schema_migrations')
+    return {version for (version,) in rows}
+
+async def pending_migrations() -> list:
+    applied = await applied_migrations()
+    return [migration for migration in MIGRATIONS if migration[0] not in applied]
+
+async def run_migrations():
+    # Блокировка на уровне сервера не даёт двум репликам накатывать миграции одновременно
+    async with db.connection() as cnx:
+        cursor = await cnx.cursor()
+        await cursor.execute('SELECT GET_LOCK(%s, %s)', ('ortp_bot_migrations', 60))
+        rows = await cursor.fetchall()
+        locked = rows[0][0] if rows else None
+        # 0 — блокировку за 60 с не отпустила другая реплика, NULL — ошибка сервера; в обоих случаях схему не трогаем
+        if locked != 1:
+            await cursor.close()
+            raise SystemExit("Не удалось получить блокировку миграций: их применяет другая реплика. Повторите запуск позже")
+        try:
+            for version, name, apply in await pending_migrations():
+                logging.info(f"Применяется миграция {version}: {name}")
+                await apply()
+                await db.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)', (version, name))
+        finally:
+            await cursor.execute('SELECT RELEASE_LOCK(%s)', ('ortp_bot_migrations',))
+            await cursor.fetchall()
+            await cursor.close()
+
+# Запросы горячих путей, для которых снимаем EXPLAIN до и после миграций
+HOT_QUERIES = [
+    ("my_requests_count", "user_id", '''
+        SELECT COUNT(*) FROM requests
+        WHERE user_id = %s AND (status != 'Done' OR created_at >= DATE_SUB(NOW(), INTERVAL 3 MONTH))
+    '''),
+    ("my_requests_page", "user_id", '''
+        SELECT issue_key, title, status, created_at, category FROM requests
+        WHERE user_id = %s AND (status != 'Done' OR created_at >= DATE_SUB(NOW(), INTERVAL 3 MONTH))
+        ORDER BY created_at DESC, issue_key DESC LIMIT 6
+    '''),
+    ("notifications_count", "user_id", 'SELECT COUNT(*) FROM notifications WHERE user_id = %s'),
+    ("notifications_page", "user_id", '''
+        SELECT id, issue_key, event_type, message_text, timestamp, is_read FROM notifications
+        WHERE user_id = %s ORDER BY timestamp DESC, id DESC LIMIT 9
+    '''),
+    ("user_by_email", "email", 'SELECT user_id FROM users WHERE email = %s'),
+]
+
+async def explain_hot_queries() -> dict:
+    # На пустой или частично размеченной базе таблицы users может ещё не быть
+    try:
+        sample = await db.fetch('SELECT user_id, email FROM users ORDER BY user_id LIMIT 1')
+    except mysql.connector.Error as e:
+        logging.warning(f"Нет образца пользователя для EXPLAIN: {e}")
+        sample = []
+    samples = {"user_id": sample[0][0], "email": sample[0][1]} if sample else {"user_id": 0, "email": ""}
+    plans = {}
+    for name, param, query in HOT_QUERIES:
+        try:
+            plans[name] = await db.fetch('EXPLAIN ' + query, (samples[param],))
+        except mysql.connector.Error as e:
+            plans[name] = [(f"нет данных: {e}",)]
+    return plans
+
+def print_plans(title: str, plans: dict):
+    print(f"=== {title} ===")
+    for name, rows in plans.items():
+        print(f"-- {name}")
+        for row in rows:
+            print("   " + " | ".join(str(value) for value in row))
+
+# === Keyset-пагинация списков ===
+# Курсор страницы: "<номер>.<направление>.<время>.<ключ>". Направления относительно опорной записи:
+# a — строго после неё, c — начиная с неё, b — строго перед ней (листание назад)
+def encode_page_cursor(page: int, direction: str, moment: datetime, key) -> str:
+    if page <= 1:
+        return "1"
+    return f"{page}.{direction}.{moment:%y%m%d%H%M%S}.{key}"
+
+def decode_page_cursor(token):
+    parts = str(token).split(".", 3)
+    if len(parts) == 4 and parts[1] in ("a", "b", "c"):
+        try:
+            key = int(parts[3]) if parts[3].isdigit() else parts[3]
+            return int(parts[0]), parts[1], datetime.strptime(parts[2], "%y%m%d%H%M%S"), key
+        except ValueError:
+            pass
+    return 1, None, None, None
+
+async def fetch_keyset_page(select: str, where: str, params: tuple, time_column: str, key_column: str, token, per_page: int):
+    page, direction, moment, key = decode_page_cursor(token)
+    if direction in ("a", "c"):
+        op = "<" if direction == "a" else "<="
+        rows = await db.fetch(
+            f"{select} WHERE {where} AND ({time_column} < %s OR ({time_column} = %s AND {key_column} {op} %s)) "
+            f"ORDER BY {time_column} DESC, {key_column} DESC LIMIT %s",
+            params + (moment, moment, key, per_page + 1)
+        )
+        if rows:
+            return page, rows[:per_page], len(rows) > per_page
+    elif direction == "b":
+        rows = await db.fetch(
+            f"{select} WHERE {where} AND ({time_column} > %s OR ({time_column} = %s AND {key_column} > %s)) "
+            f"ORDER BY {time_column} ASC, {key_column} ASC LIMIT %s",
+            params + (moment, moment, key, per_page + 1)
+        )
+        if len(rows) > per_page:
+            return page, list(reversed(rows[:per_page])), True
+    # Первая страница, а также устаревший или опустевший курсор
+    rows = await db.fetch(
+        f"{select} WHERE {where} ORDER BY {time_column} DESC, {key_column} DESC LIMIT %s",
+        params + (per_page + 1,)
     )
-''')
+    return 1, rows[:per_page], len(rows) > per_page
+
+# Приблизительное число записей для "📖 n/N": пересчитывается не чаще раза в ttl секунд
+class CountCache:
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._items = {}
+
+    async def get(self, key, query: str, params: tuple) -> int:
+        item = self._items.get(key)
+        now = time.monotonic()
+        if item and item[1] > now:
+            return item[0]
+        count = (await db.fetch(query, params))[0][0]
+        if len(self._items) > 10000:
+            self._items = {k: v for k, v in self._items.items() if v[1] > now}
+        self._items[key] = (count, now + self.ttl)
+        return count
+
+    def invalidate(self, key):
+        self._items.pop(key, None)
+
+approx_counts = CountCache(ttl=LIST_COUNT_CACHE_TTL)
+
+# === Хранилище FSM ===
+# Состояние диалогов хранится в MySQL, чтобы переживать перезапуск и быть общим для нескольких реплик.
+# Запись отложенная: изменения копятся в памяти и сбрасываются пачкой раз в flush_interval,
+# чтение сначала смотрит в несброшенные изменения, затем в базу.
+# Блокировки событий нет (Dispatcher работает с DisabledEventIsolation), поэтому другая реплика
+# может прочитать состояние, которое эта ещё не сбросила. При нескольких репликах нужна либо
+# sticky-маршрутизация апдейтов пользователя, либо flush_interval = 0 — запись сразу при изменении
+class MySQLStorage(BaseStorage):
+    def __init__(self, flush_interval: float, ttl: int, expire_interval: int, expire_batch: int):
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.expire_interval = expire_interval
+        self.expire_batch = expire_batch
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self._pending = {}
+        self._inflight = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._expire_task = None
+        self.flush_time = LatencyStats(size=100)
+        self.flushed = 0
+        self.flush_errors = 0
+        self.expired = 0
+
+    async def _write(self, key, **values):
+        self._pending.setdefault(self.key_builder.build(key), {}).update(values)
+        if self.flush_interval <= 0:
+            await self.flush()
+        # Несброшенное (или не записанное из-за ошибки) досылает фоновый цикл
+        if self._pending and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _read(self, key):
+        storage_key = self.key_builder.build(key)
+        # Пачка, которая сейчас пишется в базу, ещё не закоммичена: читаем её из памяти, а не старую строку
+        pending = {**self._inflight.get(storage_key, {}), **self._pending.get(storage_key, {})}
+        if "state" in pending and "data" in pending:
+            return pending["state"], pending["data"]
+        rows = await db.fetch('SELECT state, data FROM fsm_storage WHERE storage_key = %s', (storage_key,))
+        state, data = (rows[0][0], json.loads(rows[0][1])) if rows else (None, {})
+        return pending.get("state", state), pending.get("data", data)
+
+    async def set_state(self, key, state=None):
+        await self._write(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key):
+        state, _ = await self._read(key)
+        return state
+
+    async def set_data(self, key, data):
+        await self._write(key, data=json.loads(json.dumps(data)))
+
+    async def get_data(self, key):
+        _, data = await self._read(key)
+        return json.loads(json.dumps(data))
+
+    async def flush(self):
+        # Пачки пишутся по одной, иначе более старая могла бы закоммититься поверх новой
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            self._inflight = batch
+            started = time.monotonic()
+            try:
+                await self._store(batch)
+            except BaseException as e:
+                # Возвращаем неудачную (или прерванную остановкой) пачку, не затирая более свежие изменения
+                for storage_key, values in batch.items():
+                    self._pending[storage_key] = {**values, **self._pending.get(storage_key, {})}
+                if not isinstance(e, Exception):
+                    raise
+                self.flush_errors += 1
+                logging.error(f"Ошибка записи состояния FSM ({len(batch)} ключей): {e}")
+                return
+            finally:
+                self._inflight = {}
+            self.flushed += len(batch)
+            self.flush_time.observe(time.monotonic() - started)
+
+    async def _store(self, batch: dict):
+        deletes, full, state_only, data_only = [], [], [], []
+        for storage_key, values in batch.items():
+            if "state" in values and "data" in values:
+                if values["state"] is None and not values["data"]:
+                    deletes.append(storage_key)
+                else:
+                    full.append((storage_key, values["state"], json.dumps(values["data"], ensure_ascii=False)))
+            elif "state" in values:
+                state_only.append((storage_key, values["state"]))
+            else:
+                data_only.append((storage_key, json.dumps(values["data"], ensure_ascii=False)))
+        if deletes:
+            placeholders = ", ".join(["%s"] * len(deletes))
+            await db.execute(f'DELETE FROM fsm_storage WHERE storage_key IN ({placeholders})', tuple(deletes))
+        if full:
+            await db.executemany('''
+                INSERT INTO fsm_storage (storage_key, state, data) VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE state = VALUES(state), data = VALUES(data), updated_at = CURRENT_TIMESTAMP
+            ''', full)
+        if state_only:
+            await db.executemany('''
+                INSERT INTO fsm_storage (storage_key, state, data) VALUES (%s, %s, '{}')
+                ON DUPLICATE KEY UPDATE state = VALUES(state), updated_at = CURRENT_TIMESTAMP
+            ''', state_only)
+        if data_only:
+            await db.executemany('''
+                INSERT INTO fsm_storage (storage_key, state, data) VALUES (%s, NULL, %s)
+                ON DUPLICATE KEY UPDATE data = VALUES(data), updated_at = CURRENT_TIMESTAMP
+            ''', data_only)
+
+    async def _flush_loop(self):
+        while self._pending:
+            await asyncio.sleep(self.flush_interval if self.flush_interval > 0 else 1)
+            await self.flush()
+
+    async def expire_once(self):
+        while True:
+            rowcount = await db.execute(
+                'DELETE FROM fsm_storage WHERE updated_at < DATE_SUB(NOW(), INTERVAL %s SECOND) LIMIT %s',
+                (self.ttl, self.expire_batch)
+            )
+            self.expired += rowcount
+            if rowcount < self.expire_batch:
+                return
+
+    async def _expire_loop(self):
+        while True:
+            try:
+                await self.expire_once()
+            except Exception as e:
+                logging.error(f"Ошибка очистки состояния FSM: {e}")
+            await asyncio.sleep(self.expire_interval)
+
+    def start(self):
+        self._expire_task = asyncio.create_task(self._expire_loop())
+
+    async def close(self):
+        tasks = [task for task in (self._flush_task, self._expire_task) if task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "flushed": self.flushed,
+            "flush_errors": self.flush_errors,
+            "expired": self.expired,
+            "flush_time": self.flush_time.snapshot()
+        }
+
+fsm_storage = MySQLStorage(
+    flush_interval=FSM_FLUSH_INTERVAL,
+    ttl=FSM_TTL,
+    expire_interval=FSM_EXPIRE_INTERVAL,
+    expire_batch=FSM_EXPIRE_BATCH
+) if FSM_STORAGE == "mysql" else MemoryStorage()
+
+dp = Dispatcher(storage=fsm_storage)
+
+# === Кэш верификации пользователей ===
+class VerifiedUserCache:
+    def __init__(self, ttl: int, negative_ttl: int, max_size: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def is_verified(self, user_id: int) -> bool:
+        item = self._items.get(user_id)
+        if item and item[1] > time.monotonic():
+            self._items.move_to_end(user_id)
+            self.hits += 1
+            return item[0]
+        self.misses += 1
+        result = await db.fetch('SELECT is_verified FROM users WHERE user_id = %s', (user_id,))
+        verified = bool(result and result[0][0])
+        self.set(user_id, verified)
+        return verified
+
+    def set(self, user_id: int, verified: bool):
+        # Отрицательный ответ живёт меньше: пользователь может подтвердить почту через другую реплику
+        ttl = self.ttl if verified else self.negative_ttl
+        self._items[user_id] = (verified, time.monotonic() + ttl)
+        self._items.move_to_end(user_id)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self._items.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
+
+verified_users = VerifiedUserCache(
+    ttl=VERIFIED_CACHE_TTL,
+    negative_ttl=VERIFIED_CACHE_NEGATIVE_TTL,
+    max_size=VERIFIED_CACHE_SIZE
+)
+
+# Кладёт статус верификации в контекст хендлера как аргумент is_verified
+class AuthMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        data["is_verified"] = await verified_users.is_verified(user.id) if user else False
+        return await handler(event, data)
+
+# Telegram присылает альбом отдельными сообщениями с общим media_group_id:
+# собираем их в течение окна и передаём в обработчик одним списком album
+class AlbumMiddleware(BaseMiddleware):
+    def __init__(self, window: float):
+        self.window = window
+        self._albums = {}
+        self.albums = 0
+        self.messages = 0
+
+    # Склеиваются только альбомы для хендлеров с флагом album; остальные (например, ответ
+    # «нужен текст») получают каждую часть отдельно и сами удаляют её
+    async def __call__(self, handler, event, data):
+        if not isinstance(event, types.Message) or event.media_group_id is None or not get_flag(data, "album"):
+            return await handler(event, data)
+        key = (event.chat.id, event.media_group_id)
+        album = self._albums.get(key)
+        if album is not None:
+            album.append(event)
+            return None
+        album = self._albums[key] = [event]
+        # Окно продлевается, пока приходят новые части альбома
+        size = 0
+        while size != len(album):
+            size = len(album)
+            await asyncio.sleep(self.window)
+        del self._albums[key]
+        album.sort(key=lambda message: message.message_id)
+        self.albums += 1
+        self.messages += len(album)
+        data["album"] = album
+        return await handler(album[0], data)
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self._albums),
+            "albums": self.albums,
+            "messages": self.messages
+        }
+
+album_middleware = AlbumMiddleware(window=ALBUM_WINDOW)
+
+dp.message.middleware(AuthMiddleware())
+dp.message.middleware(album_middleware)
+dp.callback_query.middleware(AuthMiddleware())
 
 # === Состояния FSM ===
 class BotStates(StatesGroup):
@@ -160,20 +945,213 @@ class BotStates(StatesGroup):
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 # === Класс для работы с Jira ===
+class CircuitOpenError(Exception):
+    pass
+
+def is_transient_error(error: BaseException) -> bool:
+    # Сетевые сбои, таймауты, 5xx и 429 означают проблемы Jira; остальные 4xx — ошибки самого запроса
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status == 429
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+# Размыкатель: после failure_threshold сбоев подряд запросы к Jira сразу отклоняются,
+# через recovery_timeout пропускается один пробный запрос
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, recovery_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self.rejected = 0
+        self.transitions = 0
+
+    def _transition(self, state: str):
+        logging.warning(f"Размыкатель {self.name}: {self.state} -> {state}")
+        self.state = state
+        self.transitions += 1
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+
+    # Возвращает True, если этот вызов — пробный запрос полуоткрытого размыкателя
+    def before_call(self) -> bool:
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                self.rejected += 1
+                raise CircuitOpenError(f"{self.name} недоступна, запросы временно не отправляются")
+            self._transition(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                self.rejected += 1
+                raise CircuitOpenError(f"{self.name} проверяется пробным запросом")
+            self._probe_in_flight = True
+            return True
+        return False
+
+    # success: True — Jira ответила, False — сбой Jira, None — запрос отменён и ничего не говорит о Jira.
+    # Открытым и полуоткрытым размыкателем управляет только пробный запрос: запоздавшие ответы
+    # на вызовы, начатые до размыкания, состояние не меняют
+    def record(self, success: bool | None, probe: bool = False):
+        if probe:
+            self._probe_in_flight = False
+        if success is None:
+            return
+        if self.state == self.CLOSED:
+            if success:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self._transition(self.OPEN)
+            return
+        if probe:
+            if success:
+                self.failures = 0
+                self._transition(self.CLOSED)
+            else:
+                self._transition(self.OPEN)
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "transitions": self.transitions
+        }
+
 class JiraClient:
-    def __init__(self, url, token, project_key):
+    def __init__(self, url, token, project_key, connection_limit=20, keepalive_timeout=60, dns_cache_ttl=300, upload_chunk_size=256 * 1024,
+                 read_timeout=10, write_timeout=30, upload_timeout=300, read_retries=2, hedge_delay=0,
+                 breaker_threshold=5, breaker_recovery=30):
         self.url = url
         self.headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
         self.project_key = project_key
+        self.connection_limit = connection_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.upload_chunk_size = upload_chunk_size
+        self.read_timeout = aiohttp.ClientTimeout(total=read_timeout)
+        self.write_timeout = aiohttp.ClientTimeout(total=write_timeout)
+        # Загрузка больших файлов может идти долго, поэтому ограничиваем простой сокета, а не всё время
+        self.upload_timeout = aiohttp.ClientTimeout(total=None, sock_connect=write_timeout, sock_read=upload_timeout)
+        self.read_retries = read_retries
+        self.hedge_delay = hedge_delay
+        self.breaker = CircuitBreaker("Jira", breaker_threshold, breaker_recovery)
+        self.latency = {}
+        self.errors = Counter()
+        self.retries = Counter()
+        self.hedges = Counter()
+        self.labels_supported = True
+        self._session = None
+
+    # Одна сессия на весь процесс: соединения с Jira переиспользуются без повторного TLS-рукопожатия
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                limit_per_host=self.connection_limit,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    # Единая точка для всех запросов: дедлайн, размыкатель и метрики по endpoint;
+    # handle разбирает ответ внутри контекста запроса. Повторы и хеджирование — только для идемпотентных GET
+    async def _request(self, endpoint, method, path, handle, timeout, headers=None, **kwargs):
+        async def attempt():
+            probe = self.breaker.before_call()
+            started = time.perf_counter()
+            success = None
+            try:
+                async with self._get_session().request(
+                    method, f"{self.url}{path}", headers=headers or self.headers, timeout=timeout, **kwargs
+                ) as response:
+                    if response.status >= 500 or response.status == 429:
+                        response.raise_for_status()
+                    result = await handle(response)
+                success = True
+                return result
+            except Exception as e:
+                success = not is_transient_error(e)
+                if not success:
+                    self.errors[endpoint] += 1
+                raise
+            finally:
+                self.breaker.record(success, probe)
+                self.latency.setdefault(endpoint, LatencyStats()).observe(time.perf_counter() - started)
+
+        if method != "GET":
+            return await attempt()
+
+        def before_sleep(retry_state):
+            self.retries[endpoint] += 1
+            logging.warning(f"Повтор запроса Jira {endpoint} после ошибки: {retry_state.outcome.exception()}")
+
+        async for retry in AsyncRetrying(
+            stop=stop_after_attempt(self.read_retries + 1),
+            wait=wait_random_exponential(multiplier=0.5, max=5),
+            retry=retry_if_exception(is_transient_error),
+            before_sleep=before_sleep,
+            reraise=True
+        ):
+            with retry:
+                return await (self._hedged(endpoint, attempt) if self.hedge_delay > 0 else attempt())
+
+    # Если ответ не пришёл за hedge_delay, параллельно отправляем второй такой же запрос и берём первый успешный
+    async def _hedged(self, endpoint, attempt):
+        tasks = {asyncio.create_task(attempt())}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay)
+            if not done:
+                self.hedges[endpoint] += 1
+                tasks.add(asyncio.create_task(attempt()))
+            error = None
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "circuit": self.breaker.stats(),
+            "endpoints": {
+                endpoint: {
+                    "errors": self.errors[endpoint],
+                    "retries": self.retries[endpoint],
+                    "hedges": self.hedges[endpoint],
+                    "latency": latency.snapshot()
+                }
+                for endpoint, latency in self.latency.items()
+            }
+        }
 
     async def get_priorities(self):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{self.url}/rest/api/2/priority", headers=self.headers) as response:
-                response.raise_for_status()
-                priorities = await response.json()
-                return {p["name"]: p["id"] for p in priorities if p["name"].lower() in ["high", "medium", "low"]}
+        async def handle(response):
+            response.raise_for_status()
+            priorities = await response.json()
+            return {p["name"]: p["id"] for p in priorities if p["name"].lower() in ["high", "medium", "low"]}
+        return await self._request("priorities", "GET", "/rest/api/2/priority", handle, self.read_timeout)
 
-    async def create_issue(self, summary, description, priority, email, category_id):
+    async def create_issue(self, summary, description, priority, email, category_id, labels=None):
         payload = {
             "fields": {
                 "project": {"key": self.project_key},
@@ -185,98 +1163,195 @@ class JiraClient:
                 "customfield_10857": {"id": category_id}
             }
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.url}/rest/api/2/issue", headers=self.headers, json=payload) as response:
-                response.raise_for_status()
-                return (await response.json())["key"]
+        if labels and self.labels_supported:
+            payload["fields"]["labels"] = labels
+        async def handle(response):
+            if response.status == 400 and "labels" in payload["fields"]:
+                body = await response.json(content_type=None) or {}
+                if "labels" in (body.get("errors") or {}):
+                    return None
+            response.raise_for_status()
+            return (await response.json())["key"]
+        key = await self._request("create_issue", "POST", "/rest/api/2/issue", handle, self.write_timeout, json=payload)
+        if key is None:
+            # Поля labels нет на экране создания: создаём без метки и больше её не отправляем.
+            # Без метки задачу после сбоя не найти, и повтор может завести дубль
+            self.labels_supported = False
+            logging.warning(f"Jira не принимает поле labels, задачи создаются без меток идемпотентности: {labels}")
+            payload["fields"].pop("labels")
+            key = await self._request("create_issue", "POST", "/rest/api/2/issue", handle, self.write_timeout, json=payload)
+        return key
 
     async def get_issue_status(self, issue_key):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{self.url}/rest/api/2/issue/{issue_key}", headers=self.headers) as response:
-                if response.status == 404:
-                    raise Exception("Заявка не найдена")
-                response.raise_for_status()
-                data = await response.json()
-                return {
-                    "status": data["fields"]["status"]["name"],
-                    "summary": data["fields"]["summary"],
-                    "priority": data["fields"]["priority"]["name"]
-                }
+        async def handle(response):
+            if response.status == 404:
+                raise Exception("Заявка не найдена")
+            response.raise_for_status()
+            data = await response.json()
+            return {
+                "status": data["fields"]["status"]["name"],
+                "summary": data["fields"]["summary"],
+                "priority": data["fields"]["priority"]["name"]
+            }
+        return await self._request(
+            "issue_status", "GET", f"/rest/api/2/issue/{issue_key}", handle, self.read_timeout,
+            params={"fields": "status,summary,priority"}
+        )
 
     async def get_issue_comments(self, issue_key):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{self.url}/rest/api/2/issue/{issue_key}/comment",
-                headers=self.headers
-            ) as response:
-                if response.status == 404:
-                    raise Exception("Заявка не найдена")
-                response.raise_for_status()
-                data = await response.json()
-                comments = data.get("comments", [])
-                return [{"body": comment["body"], "author": comment["author"]["displayName"]} for comment in comments] if comments else []
-
-    async def add_comment_to_issue(self, issue_key, comment):
+        async def handle(response):
+            if response.status == 404:
+                raise Exception("Заявка не найдена")
+            response.raise_for_status()
+            data = await response.json()
+            comments = data.get("comments", [])
+            return [{"body": comment["body"], "author": comment["author"]["displayName"]} for comment in comments] if comments else []
+        return await self._request("issue_comments", "GET", f"/rest/api/2/issue/{issue_key}/comment", handle, self.read_timeout)
+
+    async def add_comment_to_issue(self, issue_key, comment, known_status=None):
         try:
-            issue_details = await self.get_issue_details(issue_key)
-            if issue_details is None:
-                raise Exception(f"Задача {issue_key} не найдена")
-            status = issue_details.get("status", "")
+            # Свежий статус из зеркала избавляет от лишнего запроса в Jira перед отправкой
+            if known_status is not None:
+                status = known_status
+            else:
+                issue_details = await self.get_issue_details(issue_key)
+                if issue_details is None:
+                    raise Exception(f"Задача {issue_key} не найдена")
+                status = issue_details.get("status", "")
             if status.lower() in ["готово", "done"]:
                 raise Exception(f"Задача {issue_key} в статусе 'Готово'. Комментарий не может быть добавлен.")
             payload = {"body": comment}
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.url}/rest/api/2/issue/{issue_key}/comment",
-                    headers=self.headers,
-                    json=payload
-                ) as response:
-                    if response.status == 403:
-                        raise Exception("Нет прав на добавление комментария к задаче")
-                    response.raise_for_status()
-                    return await response.json()
+
+            async def handle(response):
+                if response.status == 403:
+                    raise Exception("Нет прав на добавление комментария к задаче")
+                response.raise_for_status()
+                return await response.json()
+            return await self._request(
+                "add_comment", "POST", f"/rest/api/2/issue/{issue_key}/comment", handle, self.write_timeout, json=payload
+            )
         except Exception as e:
             logging.error(f"Ошибка при добавлении комментария к задаче {issue_key}: {e}")
             raise e
 
+    async def upload_attachment(self, issue_key, file_name, chunks):
+        # chunks — асинхронный итератор байтов, тело уходит в Jira по мере чтения
+        headers = self.headers.copy()
+        headers.pop('Content-Type')
+        headers['X-Atlassian-Token'] = 'no-check'
+        form = aiohttp.FormData()
+        form.add_field('file', chunks, filename=file_name, content_type='application/octet-stream')
+
+        async def handle(response):
+            response.raise_for_status()
+            return await response.json()
+        return await self._request(
+            "attachment", "POST", f"/rest/api/2/issue/{issue_key}/attachments", handle, self.upload_timeout,
+            headers=headers, data=form
+        )
+
     async def add_attachment(self, issue_key, file_path):
-        async with aiohttp.ClientSession() as session:
-            form = aiohttp.FormData()
-            form.add_field('file', open(file_path, 'rb'))
-            headers = self.headers.copy()
-            headers.pop('Content-Type')
-            headers['X-Atlassian-Token'] = 'no-check'
-            async with session.post(
-                f"{self.url}/rest/api/2/issue/{issue_key}/attachments",
-                headers=headers,
-                data=form
-            ) as response:
-                response.raise_for_status()
-                return await response.json()
+        # Файл читается с диска кусками прямо в тело запроса и закрывается при выходе из блока
+        async with aiofiles.open(file_path, 'rb') as file:
+            async def chunks():
+                while chunk := await file.read(self.upload_chunk_size):
+                    yield chunk
+            return await self.upload_attachment(issue_key, os.path.basename(file_path), chunks())
+
+    async def add_attachments(self, issue_key, uploads, concurrency=4, retries=2):
+        # uploads — список пар (имя, фабрика корутины загрузки): при повторе источник открывается заново
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def upload(name, start):
+            async with semaphore:
+                for attempt in range(retries + 1):
+                    try:
+                        return await start()
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        # Ошибки клиента (4xx) повторять бессмысленно, оборванную загрузку — повторяем
+                        client_error = isinstance(e, aiohttp.ClientResponseError) and e.status < 500
+                        if client_error or attempt == retries:
+                            raise
+                        logging.warning(f"Повтор загрузки {name} в {issue_key} после ошибки: {e}")
+                        await asyncio.sleep(2 ** attempt)
+
+        results = await asyncio.gather(*(upload(name, start) for name, start in uploads), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            logging.error(f"Не удалось загрузить {len(errors)} из {len(uploads)} вложений в {issue_key}")
+            raise errors[0]
 
     async def get_issue_details(self, issue_key):
+        async def handle(response):
+            if response.status == 404:
+                logging.error(f"Задача {issue_key} не найдена в Jira")
+                return None
+            response.raise_for_status()
+            data = await response.json()
+            fields = data.get("fields", {})
+            return {
+                "summary": fields.get("summary", "Нет заголовка"),
+                "description": fields.get("description", "Нет описания"),
+                "assignee": (fields.get("assignee") or {}).get("displayName", "Не назначен"),
+                "status": fields.get("status", {}).get("name", "Неизвестно"),
+                "priority": fields.get("priority", {}).get("name", "Неизвестно"),
+                "created": fields.get("created", "Нет данных"),
+                "updated": fields.get("updated", "Нет данных"),
+            }
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"{self.url}/rest/api/2/issue/{issue_key}", headers=self.headers) as response:
-                    if response.status == 404:
-                        logging.error(f"Задача {issue_key} не найдена в Jira")
-                        return None
-                    response.raise_for_status()
-                    data = await response.json()
-                    fields = data.get("fields", {})
-                    return {
-                        "summary": fields.get("summary", "Нет заголовка"),
-                        "description": fields.get("description", "Нет описания"),
-                        "assignee": (fields.get("assignee") or {}).get("displayName", "Не назначен"),
-                        "status": fields.get("status", {}).get("name", "Неизвестно"),
-                        "priority": fields.get("priority", {}).get("name", "Неизвестно"),
-                        "created": fields.get("created", "Нет данных"),
-                        "updated": fields.get("updated", "Нет данных"),
-                    }
+            return await self._request(
+                "issue_details", "GET", f"/rest/api/2/issue/{issue_key}", handle, self.read_timeout,
+                params={"fields": "summary,description,assignee,status,priority,created,updated"}
+            )
         except Exception as e:
             logging.error(f"Ошибка при получении данных задачи {issue_key}: {e}")
             return None
 
+    # Карточка задачи одним запросом: только нужные поля и комментарии в том же ответе
+    async def get_issue_view(self, issue_key, skip_authors=()):
+        async def handle(response):
+            if response.status == 404:
+                logging.error(f"Задача {issue_key} не найдена в Jira")
+                return None
+            response.raise_for_status()
+            return await response.json()
+        data = await self._request(
+            "issue_view", "GET", f"/rest/api/2/issue/{issue_key}", handle, self.read_timeout,
+            params={"fields": "summary,description,assignee,status,priority,created,updated,comment"}
+        )
+        if data is None:
+            return None
+        fields = data.get("fields", {})
+        comments = [
+            comment for comment in (fields.get("comment") or {}).get("comments", [])
+            if comment["author"]["displayName"] not in skip_authors
+        ]
+        return {
+            "summary": fields.get("summary", "Нет заголовка"),
+            "description": fields.get("description", "Нет описания"),
+            "assignee": (fields.get("assignee") or {}).get("displayName", "Не назначен"),
+            "status": fields.get("status", {}).get("name", "Неизвестно"),
+            "priority": fields.get("priority", {}).get("name", "Неизвестно"),
+            "created": fields.get("created", "Нет данных"),
+            "updated": fields.get("updated", "Нет данных"),
+            "last_comment": comments[-1]["body"] if comments else None,
+            "last_comment_author": comments[-1]["author"]["displayName"] if comments else None
+        }
+
+    async def search_issues(self, jql, fields, start_at=0, max_results=100):
+        async def handle(response):
+            response.raise_for_status()
+            return await response.json()
+        return await self._request(
+            "search", "GET", "/rest/api/2/search", handle, self.read_timeout,
+            params={"jql": jql, "fields": ",".join(fields), "startAt": start_at, "maxResults": max_results}
+        )
+
+    async def find_issue_by_label(self, label):
+        page = await self.search_issues(f'project = {self.project_key} AND labels = "{label}"', ["key"], max_results=1)
+        issues = page.get("issues", [])
+        return issues[0]["key"] if issues else None
+
     async def register_webhook(self, webhook_url):
         payload = {
             "name": "Telegram Bot Status Change Webhook",
@@ -289,16 +1364,229 @@ class JiraClient:
             "excludeBody": False,
             "secret": WEBHOOK_SECRET
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.url}/rest/webhooks/1.0/webhook", headers=self.headers, json=payload) as response:
-                response_text = await response.text()
-                logging.info(f"Webhook registration response: {response.status} - {response_text}")
-                if response.status != 200:
-                    logging.error(f"Failed to register webhook: {response_text}")
-                    return None
-                return await response.json()
+        async def handle(response):
+            response_text = await response.text()
+            logging.info(f"Webhook registration response: {response.status} - {response_text}")
+            if response.status != 200:
+                logging.error(f"Failed to register webhook: {response_text}")
+                return None
+            return await response.json()
+        return await self._request("register_webhook", "POST", "/rest/webhooks/1.0/webhook", handle, self.write_timeout, json=payload)
+
+jira_client = JiraClient(
+    JIRA_URL,
+    BEARER_TOKEN,
+    JIRA_PROJECT_KEY,
+    connection_limit=JIRA_CONNECTION_LIMIT,
+    keepalive_timeout=JIRA_KEEPALIVE_TIMEOUT,
+    dns_cache_ttl=JIRA_DNS_CACHE_TTL,
+    read_timeout=JIRA_READ_TIMEOUT,
+    write_timeout=JIRA_WRITE_TIMEOUT,
+    upload_timeout=JIRA_UPLOAD_TIMEOUT,
+    read_retries=JIRA_READ_RETRIES,
+    hedge_delay=JIRA_HEDGE_DELAY,
+    breaker_threshold=JIRA_BREAKER_THRESHOLD,
+    breaker_recovery=JIRA_BREAKER_RECOVERY
+)
+
+# === Кэш приоритетов Jira ===
+class PriorityCache:
+    def __init__(self, client: JiraClient, ttl: int):
+        self.client = client
+        self.ttl = ttl
+        self._priorities = None
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+        self._refresh_task = None
+        self.hits = 0
+        self.misses = 0
+        self.refresh_failures = 0
+
+    def _is_fresh(self) -> bool:
+        return self._priorities is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    async def get(self) -> dict:
+        if self._priorities is not None:
+            self.hits += 1
+            # Устаревшее значение отдаём сразу, а обновляем в фоне, чтобы не ждать медленную Jira
+            if not self._is_fresh() and not self._lock.locked():
+                asyncio.create_task(self.refresh())
+            return self._priorities
+        self.misses += 1
+        return await self.refresh()
+
+    async def name_by_id(self, priority_id: str):
+        priorities = await self.get()
+        return next((name for name, id in priorities.items() if id == priority_id), None)
+
+    async def refresh(self, force: bool = False) -> dict:
+        async with self._lock:
+            if self._is_fresh() and not force:
+                return self._priorities
+            try:
+                self._priorities = await self.client.get_priorities()
+                self._loaded_at = time.monotonic()
+            except Exception as e:
+                self.refresh_failures += 1
+                if self._priorities is None:
+                    raise
+                logging.warning(f"Не удалось обновить приоритеты Jira, используем последние известные: {e}")
+            return self._priorities
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl / 2)
+            try:
+                await self.refresh(force=True)
+            except Exception as e:
+                logging.error(f"Ошибка фонового обновления приоритетов Jira: {e}")
 
-jira_client = JiraClient(JIRA_URL, BEARER_TOKEN, JIRA_PROJECT_KEY)
+    async def start(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            logging.error(f"Не удалось загрузить приоритеты Jira при старте: {e}")
+        self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refresh_failures": self.refresh_failures,
+            "age_s": round(time.monotonic() - self._loaded_at, 1) if self._priorities is not None else None
+        }
+
+priority_cache = PriorityCache(jira_client, ttl=JIRA_PRIORITY_CACHE_TTL)
+
+# === Исходящие сообщения Telegram ===
+LANE_INTERACTIVE = 0
+LANE_BULK = 1
+
+# Полоса задаётся контекстом задачи: ответы пользователю идут вперёд массовых уведомлений
+outbound_lane = ContextVar("outbound_lane", default=LANE_INTERACTIVE)
+
+RATE_LIMITED_METHODS = (
+    SendMessage, SendPhoto, SendVideo, SendDocument, SendMediaGroup,
+    EditMessageText, EditMessageCaption, EditMessageMedia, EditMessageReplyMarkup
+)
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _available(self, now: float) -> float:
+        return min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+
+    # Резервирует токен и возвращает, сколько нужно подождать до его появления
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self.tokens = self._available(now)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    # Токены считаем с учётом пополнения с последнего запроса, иначе ведро после всплеска никогда не выглядит простаивающим
+    def is_idle(self) -> bool:
+        now = time.monotonic()
+        return self._available(now) >= self.capacity - 1 and self.blocked_until < now
+
+class OutboundScheduler(BaseRequestMiddleware):
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int, max_retries: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets = {}
+        self._queue = asyncio.PriorityQueue()
+        self._seq = 0
+        self._task = None
+        self.queue_wait = {LANE_INTERACTIVE: LatencyStats(), LANE_BULK: LatencyStats()}
+        self.sent = {LANE_INTERACTIVE: 0, LANE_BULK: 0}
+        self.retries = 0
+        self.failed = 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.is_idle()}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _dispatch_loop(self):
+        while True:
+            _, _, ready = await self._queue.get()
+            await asyncio.sleep(self.global_bucket.reserve())
+            if not ready.done():
+                ready.set_result(None)
+
+    async def _acquire(self, chat_id, lane: int):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._dispatch_loop())
+        started = time.monotonic()
+        await asyncio.sleep(self._chat_bucket(chat_id).reserve())
+        ready = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        await self._queue.put((lane, self._seq, ready))
+        await ready
+        self.queue_wait[lane].observe(time.monotonic() - started)
+
+    async def __call__(self, make_request, bot, method):
+        if not isinstance(method, RATE_LIMITED_METHODS):
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        lane = outbound_lane.get()
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id, lane)
+            try:
+                response = await make_request(bot, method)
+                self.sent[lane] += 1
+                return response
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    self.failed += 1
+                    raise
+                self.retries += 1
+                logging.warning(f"Telegram 429 для чата {chat_id}: повтор через {e.retry_after} с")
+                self._chat_bucket(chat_id).block(e.retry_after)
+                if chat_id is None:
+                    self.global_bucket.block(e.retry_after)
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "chats": len(self._chat_buckets),
+            "sent_interactive": self.sent[LANE_INTERACTIVE],
+            "sent_bulk": self.sent[LANE_BULK],
+            "retries": self.retries,
+            "failed": self.failed,
+            "queue_wait_interactive": self.queue_wait[LANE_INTERACTIVE].snapshot(),
+            "queue_wait_bulk": self.queue_wait[LANE_BULK].snapshot()
+        }
+
+outbound = OutboundScheduler(
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    chat_rate=TELEGRAM_CHAT_RATE,
+    chat_burst=TELEGRAM_CHAT_BURST,
+    max_retries=TELEGRAM_MAX_RETRIES
+)
+bot.session.middleware(outbound)
 
 # === Генерация клавиатур ===
 main_keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -340,9 +1628,28 @@ comment_keyboard = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="↩️", callback_data="back_to_requests")]
 ])
 
+category_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+    *[[InlineKeyboardButton(text=name, callback_data=f"category_{id}")] for name, id in CATEGORIES.items()],
+    [InlineKeyboardButton(text="↩️", callback_data="cancel")]
+])
+
+# Клавиатуры собираются один раз, поэтому время в callback_data не зашивается:
+# возраст кнопок считается по дате сообщения на стороне Telegram (последнее редактирование или отправка)
+def is_keyboard_expired(callback: types.CallbackQuery, ttl: int = KEYBOARD_TTL) -> bool:
+    message = callback.message
+    if message is None or not isinstance(message, types.Message):
+        return True
+    # edit_date приходит unix-временем, date — datetime
+    rendered_at = message.edit_date or message.date.timestamp()
+    return datetime.now(timezone.utc).timestamp() - rendered_at > ttl
+
+# Повторная отрисовка того же списка (например, нажатие на «📖 n/N») Telegram отклоняет как «message is not modified»
+def is_message_not_modified(error: Exception) -> bool:
+    return isinstance(error, TelegramBadRequest) and "message is not modified" in str(error)
+
 # === Обработка отмены ===
 async def handle_cancel(callback: types.CallbackQuery, state: FSMContext):
-    await state.clear()
+    await abandon_draft(callback.from_user.id, state)
     await callback.message.edit_text("💆‍♂️  Главное меню  💆‍♀️", reply_markup=main_keyboard)
     await callback.answer()
 
@@ -350,7 +1657,7 @@ async def handle_cancel(callback: types.CallbackQuery, state: FSMContext):
 async def handle_back(callback: types.CallbackQuery, state: FSMContext):
     current_state = await state.get_state()
     if current_state == BotStates.create_title.state:
-        await callback.message.edit_text("🙇‍♀️ Выберите категорию:", reply_markup=create_category_keyboard())
+        await callback.message.edit_text("🙇‍♀️ Выберите категорию:", reply_markup=category_keyboard)
         await state.set_state(BotStates.create_category)
     elif current_state == BotStates.create_description.state:
         await callback.message.edit_text("👩‍🏫 Введите тему заявки:", reply_markup=back_to_category_keyboard)
@@ -364,19 +1671,19 @@ async def handle_back(callback: types.CallbackQuery, state: FSMContext):
         )
         await state.set_state(BotStates.create_description)
     else:
-        await state.clear()
+        await abandon_draft(callback.from_user.id, state)
         await callback.message.edit_text("💆‍♂️  Главное меню  💆‍♀️", reply_markup=main_keyboard)
     await callback.answer()
 
 # === Обработка кнопки "Назад к заявкам" ===
 async def handle_back_to_requests(callback: types.CallbackQuery, state: FSMContext):
-    await state.clear()
+    await abandon_draft(callback.from_user.id, state)
     await show_my_requests(callback, 1)
     await callback.answer()
 
 # === Обработка кнопки "Назад к категории" ===
 async def handle_back_to_category(callback: types.CallbackQuery, state: FSMContext):
-    await callback.message.edit_text("🙇‍♀️ Выберите категорию:", reply_markup=create_category_keyboard())
+    await callback.message.edit_text("🙇‍♀️ Выберите категорию:", reply_markup=category_keyboard)
     await state.set_state(BotStates.create_category)
     await callback.answer()
 
@@ -402,22 +1709,128 @@ async def send_progress_animation(message: types.Message):
     progress_message = await message.answer("⏳ Обработка...")
     return progress_message
 
-# Функция для отправки кода на почту
+# === Отправка почты ===
+class MailSender:
+    def __init__(self, server, port, user, password, backend: str, queue_size: int, max_retries: int, idle_timeout: int):
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        self.backend = backend
+        self.max_retries = max_retries
+        self.idle_timeout = idle_timeout
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._smtp = None
+        self._task = None
+        self._retry_tasks = set()
+        self.delivery_time = LatencyStats()
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def enqueue(self, msg: EmailMessage) -> bool:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._worker())
+        try:
+            self.queue.put_nowait((msg, 0))
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            logging.error(f"Очередь писем переполнена, письмо для {msg['To']} не поставлено")
+            return False
+
+    # Блокирующая часть выполняется в отдельном потоке; соединение переиспользуется между письмами
+    def _deliver(self, msg: EmailMessage):
+        if self.backend == "log":
+            logging.info(f"[SMTP_BACKEND=log] Письмо для {msg['To']}: {msg.get_content().strip()}")
+            return
+        for attempt in range(2):
+            if self._smtp is None:
+                smtp = smtplib.SMTP(self.server, self.port, timeout=30)
+                smtp.starttls()
+                smtp.login(self.user, self.password)
+                self._smtp = smtp
+            try:
+                self._smtp.send_message(msg)
+                return
+            except smtplib.SMTPServerDisconnected:
+                # Сервер закрыл простаивавшее соединение: переподключаемся один раз
+                self._smtp = None
+                if attempt:
+                    raise
+
+    def _disconnect(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+            self._smtp = None
+
+    async def _retry_later(self, msg: EmailMessage, attempt: int):
+        await asyncio.sleep(2 ** attempt)
+        await self.queue.put((msg, attempt))
+
+    async def _worker(self):
+        while True:
+            try:
+                msg, attempt = await asyncio.wait_for(self.queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                await asyncio.to_thread(self._disconnect)
+                continue
+            started = time.monotonic()
+            try:
+                await asyncio.to_thread(self._deliver, msg)
+                self.sent += 1
+                self.delivery_time.observe(time.monotonic() - started)
+            except Exception as e:
+                await asyncio.to_thread(self._disconnect)
+                if attempt < self.max_retries:
+                    self.retries += 1
+                    logging.warning(f"Ошибка отправки письма для {msg['To']}, попытка {attempt + 1}: {e}")
+                    task = asyncio.create_task(self._retry_later(msg, attempt + 1))
+                    self._retry_tasks.add(task)
+                    task.add_done_callback(self._retry_tasks.discard)
+                else:
+                    self.failed += 1
+                    logging.error(f"Ошибка отправки письма для {msg['To']}: {e}")
+
+    async def stop(self):
+        for task in [self._task, *self._retry_tasks]:
+            if task:
+                task.cancel()
+        await asyncio.to_thread(self._disconnect)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "sent": self.sent,
+            "retries": self.retries,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "delivery_time": self.delivery_time.snapshot()
+        }
+
+mail_sender = MailSender(
+    SMTP_SERVER,
+    SMTP_PORT,
+    SMTP_USER,
+    SMTP_PASSWORD,
+    backend=SMTP_BACKEND,
+    queue_size=SMTP_QUEUE_SIZE,
+    max_retries=SMTP_MAX_RETRIES,
+    idle_timeout=SMTP_IDLE_TIMEOUT
+)
+
+# Функция для отправки кода на почту: письмо уходит в очередь, ответ пользователю не ждёт SMTP
 def send_verification_code(email: str, code: str) -> bool:
-    try:
-        msg = EmailMessage()
-        msg["Subject"] = "Код подтверждения для бота"
-        msg["From"] = SMTP_USER
-        msg["To"] = email
-        msg.set_content(f"Ваш код подтверждения: {code}\n\nКод действителен 10 минут.")
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(SMTP_USER, SMTP_PASSWORD)
-            server.send_message(msg)
-        return True
-    except Exception as e:
-        logging.error(f"Ошибка отправки письма: {e}")
-        return False
+    msg = EmailMessage()
+    msg["Subject"] = "Код подтверждения для бота"
+    msg["From"] = SMTP_USER
+    msg["To"] = email
+    msg.set_content(f"Ваш код подтверждения: {code}\n\nКод действителен 10 минут.")
+    return mail_sender.enqueue(msg)
 
 # Функция проверки почты
 def is_valid_email(email: str) -> bool:
@@ -427,6 +1840,151 @@ def is_valid_email(email: str) -> bool:
 def generate_verification_code() -> str:
     return str(random.randint(100000, 999999))
 
+# === Вложения из Telegram ===
+def media_item_from_message(message: types.Message, prefix: str = ""):
+    if message.photo:
+        file_info = message.photo[-1]
+        return {"file_id": file_info.file_id, "file_name": f"{prefix}photo_{file_info.file_id}.jpg"}
+    if message.video:
+        file_info = message.video
+        ext = (file_info.mime_type.split('/')[-1] if file_info.mime_type else 'mp4')
+        return {"file_id": file_info.file_id, "file_name": f"{prefix}video_{file_info.file_id}.{ext}"}
+    if message.document:
+        file_info = message.document
+        return {"file_id": file_info.file_id, "file_name": file_info.file_name or f"{prefix}document_{file_info.file_id}"}
+    return None
+
+async def fetch_media_item(item):
+    # get_file проверяет файл сразу (например, лимит Telegram в 20 Мб), даже если скачивать его пока не нужно
+    file = await bot.get_file(item["file_id"])
+    if MEDIA_RELAY_MODE == "disk":
+        file_path = os.path.join(PHOTOS_DIR, item["file_name"])
+        await bot.download_file(file.file_path, file_path, timeout=MEDIA_RELAY_TIMEOUT)
+        item["path"] = file_path
+    return item
+
+async def relay_media_item(issue_key, item):
+    # Ссылка на файл живёт около часа, поэтому путь запрашивается заново перед каждой отправкой
+    file = await bot.get_file(item["file_id"])
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    chunks = bot.session.stream_content(url=url, timeout=MEDIA_RELAY_TIMEOUT, raise_for_status=True)
+    return await jira_client.upload_attachment(issue_key, item["file_name"], chunks)
+
+# uploaded, если передан, пополняется file_id успешно загруженных файлов — так повтор не дублирует вложения
+async def upload_media(issue_key, items, uploaded=None):
+    def uploader(item):
+        async def start():
+            # Файл, пропавший с диска (например, после перезапуска контейнера), берём заново из Telegram
+            if item.get("path") and os.path.exists(item["path"]):
+                result = await jira_client.add_attachment(issue_key, item["path"])
+            else:
+                result = await relay_media_item(issue_key, item)
+            if uploaded is not None:
+                uploaded.append(item["file_id"])
+            return result
+        return start
+
+    uploads = [(item["file_name"], uploader(item)) for item in items]
+    await jira_client.add_attachments(
+        issue_key, uploads,
+        concurrency=ATTACHMENT_UPLOAD_CONCURRENCY,
+        retries=ATTACHMENT_UPLOAD_RETRIES
+    )
+
+def media_added_text(count: int) -> str:
+    return "✅ Файл добавлен" if count == 1 else f"✅ Файлов добавлено: {count}"
+
+async def delete_user_messages(chat_id: int, messages):
+    try:
+        if len(messages) == 1:
+            await messages[0].delete()
+        else:
+            await bot.delete_messages(chat_id=chat_id, message_ids=[message.message_id for message in messages])
+    except Exception as e:
+        logging.error(f"Ошибка при удалении сообщений с файлами: {e}")
+
+def discard_media(items):
+    for item in items:
+        path = item.get("path")
+        if path and os.path.exists(path):
+            os.remove(path)
+
+class MediaDownloads:
+    def __init__(self, per_user: int):
+        self.per_user = per_user
+        self._users = {}
+        self.download_time = LatencyStats()
+        self.completed = 0
+        self.failed = 0
+
+    def submit(self, user_id: int, item):
+        semaphore, tasks = self._users.setdefault(user_id, (asyncio.Semaphore(self.per_user), {}))
+        tasks[item["file_id"]] = asyncio.create_task(self._download(semaphore, item))
+
+    async def _download(self, semaphore, item):
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                await fetch_media_item(item)
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Ошибка при загрузке файла {item['file_name']}: {e}")
+                raise
+            self.completed += 1
+            self.download_time.observe(time.monotonic() - started)
+            return item
+
+    # Дожидается фоновых загрузок пользователя; файлы, которые скачать не удалось, выбрасываются из списка
+    async def resolve(self, user_id: int, items):
+        _, tasks = self._users.pop(user_id, (None, {}))
+        pending = [tasks.pop(item["file_id"], None) for item in items]
+        results = await asyncio.gather(*(task for task in pending if task), return_exceptions=True)
+        results = iter(results)
+        ready, failed = [], 0
+        for item, task in zip(items, pending):
+            # Элемент без задачи уже был разрешён ранее (например, пользователь вернулся назад)
+            result = next(results) if task else item
+            if isinstance(result, BaseException):
+                failed += 1
+            else:
+                ready.append(result)
+        self._drop(tasks.values())
+        return ready, failed
+
+    # Отменяет незавершённые загрузки брошенного диалога и удаляет уже скачанные файлы
+    def discard(self, user_id: int):
+        _, tasks = self._users.pop(user_id, (None, {}))
+        self._drop(tasks.values())
+
+    def _drop(self, tasks):
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                discard_media([task.result()])
+
+    async def stop(self):
+        for user_id in list(self._users):
+            self.discard(user_id)
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._users),
+            "pending": sum(1 for _, tasks in self._users.values() for task in tasks.values() if not task.done()),
+            "completed": self.completed,
+            "failed": self.failed,
+            "download_time": self.download_time.snapshot()
+        }
+
+media_downloads = MediaDownloads(per_user=MEDIA_DOWNLOAD_PER_USER)
+
+# Выход из диалога без отправки: отменяем фоновые загрузки и удаляем файлы черновика с диска
+async def abandon_draft(user_id: int, state: FSMContext):
+    data = await state.get_data()
+    media_downloads.discard(user_id)
+    discard_media(data.get("media_files", []) + data.get("comment_files", []))
+    await state.clear()
+
 # Вспомогательная функция для удаления сообщения через задержку
 async def delete_after_delay(chat_id: int, message_id: int, delay: int):
     await asyncio.sleep(delay)
@@ -435,23 +1993,16 @@ async def delete_after_delay(chat_id: int, message_id: int, delay: int):
     except Exception as e:
         logging.error(f"Ошибка при удалении сообщения {message_id}: {e}")
 
-def create_category_keyboard():
-    buttons = [
-        [InlineKeyboardButton(text=name, callback_data=f"category_{id}_{int(time.time())}")]
-        for name, id in CATEGORIES.items()
-    ]
-    buttons.append([InlineKeyboardButton(text="↩️", callback_data="cancel")])
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
-
-def get_team_members_full():
-    rows = execute_query('''
-        SELECT position, last_name, first_name, middle_name, photo_path, description, telegram, game, pulse
+async def get_team_members_full():
+    rows = await db.fetch('''
+        SELECT id, position, last_name, first_name, middle_name, photo_path, description, telegram, game, pulse,
+               photo_file_id, photo_file_source
         FROM team
         ORDER BY id ASC
-    ''', fetch=True) or []
+    ''') or []
     members = []
     for r in rows:
-        position, last_name, first_name, middle_name, photo_path, description, telegram, game, pulse = r
+        member_id, position, last_name, first_name, middle_name, photo_path, description, telegram, game, pulse, photo_file_id, photo_file_source = r
         contacts = []
         if telegram:
             contacts.append(f'<a href="{telegram}">✈️ Telegram</a>\n')
@@ -461,22 +2012,68 @@ def get_team_members_full():
             contacts.append(f'<a href="{pulse}">📈 Пульс</a>')
         contacts_text = "".join(contacts) if contacts else "Контакты отсутствуют"
         members.append({
+            "id": member_id,
             "fio": f"{position} {last_name} {first_name} {middle_name}",
             "caption": f"👤 <i>{position}</i>  <b>{middle_name} {first_name} {last_name}</b>\n\n📝 <i>{description}</i>\n\n☎️ Контакты:\n{contacts_text}",
-            "photo_path": photo_path or ""
+            "photo_path": photo_path or "",
+            # Если фото заменили, сохранённый file_id относится к старому файлу и не используется
+            "photo_file_id": photo_file_id if photo_path and photo_file_source == photo_path else None
         })
     return members
 
+# Состав команды с готовыми подписями держим в памяти; таблицу team бот не меняет (правят её напрямую в БД),
+# поэтому сброса нет — правки подхватываются по истечении TEAM_CACHE_TTL
+class TeamRoster:
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._members = None
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.loads = 0
+        self.photo_uploads = 0
+
+    def _fresh(self) -> bool:
+        return self._members is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    async def get(self):
+        if self._fresh():
+            self.hits += 1
+            return self._members
+        async with self._lock:
+            if not self._fresh():
+                self._members = await get_team_members_full()
+                self._loaded_at = time.monotonic()
+                self.loads += 1
+        return self._members
+
+    async def remember_photo(self, member: dict, file_id: str | None):
+        member["photo_file_id"] = file_id
+        if file_id:
+            self.photo_uploads += 1
+        await db.execute(
+            'UPDATE team SET photo_file_id = %s, photo_file_source = %s WHERE id = %s',
+            (file_id, member["photo_path"] if file_id else None, member["id"])
+        )
+
+    def stats(self) -> dict:
+        return {
+            "members": len(self._members) if self._members is not None else None,
+            "hits": self.hits,
+            "loads": self.loads,
+            "photo_uploads": self.photo_uploads
+        }
+
+team_roster = TeamRoster(ttl=TEAM_CACHE_TTL)
+
 # Определение, нужно ли отправлять уведомление
 def should_notify(*args, **kwargs) -> bool:
     return True
 
 # === Хендлеры ===
 @dp.message(F.text == "/start")
-async def start_command(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    result = execute_query('SELECT is_verified FROM users WHERE user_id = %s', (user_id,), fetch=True)
-    if result and result[0][0]:
+async def start_command(message: types.Message, state: FSMContext, is_verified: bool):
+    if is_verified:
         await message.answer(
             f"🙋‍♂️ Привет, {message.from_user.first_name}! 🙋‍♀️\n\n"
             "Выбери действие из меню ниже:",
@@ -518,7 +2115,7 @@ async def process_email(message: types.Message, state: FSMContext):
         return
 
     user_id = message.from_user.id
-    result = execute_query('SELECT user_id FROM users WHERE email = %s', (email,), fetch=True)
+    result = await db.fetch('SELECT user_id FROM users WHERE email = %s', (email,))
     if result and result[0][0] != user_id:
         await bot.delete_message(
             chat_id=message.chat.id,
@@ -531,14 +2128,15 @@ async def process_email(message: types.Message, state: FSMContext):
         )
         return
 
-    execute_query(
+    await db.execute(
         'INSERT INTO users (user_id, email, is_verified) VALUES (%s, %s, FALSE) ON DUPLICATE KEY UPDATE email = %s, is_verified = FALSE',
         (user_id, email, email)
     )
+    verified_users.set(user_id, False)
     code = generate_verification_code()
     expires_at = datetime.now() + timedelta(minutes=10)
     last_request_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    execute_query(
+    await db.execute(
         'INSERT INTO verification_codes (user_id, code, expires_at, last_request_at) VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE code = %s, expires_at = %s, last_request_at = %s',
         (user_id, code, expires_at.strftime("%Y-%m-%d %H:%M:%S"), last_request_at, code, expires_at.strftime("%Y-%m-%d %H:%M:%S"), last_request_at)
     )
@@ -569,8 +2167,7 @@ async def process_email(message: types.Message, state: FSMContext):
 async def delayed_edit_message(chat_id: int, message_id: int, sleep_time: float, is_expired: bool):
     await asyncio.sleep(sleep_time)
     
-    result = execute_query('SELECT is_verified FROM users WHERE user_id = %s', (chat_id,), fetch=True)
-    if result and result[0][0]:
+    if await verified_users.is_verified(chat_id):
         return
     
     new_text = "❌ Код устарел или неверен. Запросите новый." if is_expired else "🙆‍♂️ Неверный код 🙆‍♀️\n\n Попробуйте ввести его снова, либо запросите новый."
@@ -587,6 +2184,7 @@ async def delayed_edit_message(chat_id: int, message_id: int, sleep_time: float,
     except Exception as e:
         logging.error(f"Ошибка при редактировании сообщения после таймаута: {e}")
 
+@lru_cache(maxsize=256)
 def build_carousel_kb(index: int, total: int) -> InlineKeyboardMarkup:
     prev_cb = f"team_carousel_prev_{index}"
     next_cb = f"team_carousel_next_{index}"
@@ -599,18 +2197,40 @@ def build_carousel_kb(index: int, total: int) -> InlineKeyboardMarkup:
     ])
     return kb
 
+# Фото отправляется по сохранённому file_id; байты загружаются только в первый раз,
+# после чего file_id из ответа Telegram запоминается в team
+async def send_member_photo(send, member: dict):
+    if member["photo_file_id"]:
+        try:
+            return await send(member["photo_file_id"])
+        except TelegramBadRequest as e:
+            if "file" not in str(e).lower():
+                raise
+            logging.warning(f"file_id фото {member['fio']} больше не действителен: {e}")
+            await team_roster.remember_photo(member, None)
+    msg = await send(types.FSInputFile(member["photo_path"]))
+    if isinstance(msg, types.Message) and msg.photo:
+        await team_roster.remember_photo(member, msg.photo[-1].file_id)
+    return msg
+
 async def edit_member_message_or_send_new(chat_id: int, message_id: int | None, member: dict, index: int, total: int):
     kb = build_carousel_kb(index, total)
     caption = member["caption"]
     photo_path = member["photo_path"]
-    has_photo = bool(photo_path and os.path.exists(photo_path))
+    has_photo = bool(member["photo_file_id"] or (photo_path and os.path.exists(photo_path)))
 
     if message_id:
         if has_photo:
             try:
-                with open(photo_path, "rb") as f:
-                    media = types.InputMediaPhoto(type="photo", media=types.BufferedInputFile(f.read(), filename=os.path.basename(photo_path)), caption=caption, parse_mode="HTML")
-                await bot.edit_message_media(chat_id=chat_id, message_id=message_id, media=media, reply_markup=kb)
+                await send_member_photo(
+                    lambda photo: bot.edit_message_media(
+                        chat_id=chat_id,
+                        message_id=message_id,
+                        media=types.InputMediaPhoto(type="photo", media=photo, caption=caption, parse_mode="HTML"),
+                        reply_markup=kb
+                    ),
+                    member
+                )
                 return message_id, True
             except Exception:
                 try:
@@ -630,12 +2250,10 @@ async def edit_member_message_or_send_new(chat_id: int, message_id: int | None,
                     pass
 
     if has_photo:
-        with open(photo_path, "rb") as f:
-            msg = await bot.send_photo(chat_id=chat_id,
-                                       photo=types.BufferedInputFile(f.read(), filename=os.path.basename(photo_path)),
-                                       caption=caption,
-                                       parse_mode="HTML",
-                                       reply_markup=kb)
+        msg = await send_member_photo(
+            lambda photo: bot.send_photo(chat_id=chat_id, photo=photo, caption=caption, parse_mode="HTML", reply_markup=kb),
+            member
+        )
         return msg.message_id, True
     else:
         msg = await bot.send_message(chat_id=chat_id, text=caption, parse_mode="HTML", reply_markup=kb)
@@ -655,10 +2273,9 @@ async def process_code(message: types.Message, state: FSMContext):
         await state.update_data(bot_message_id=sent_message.message_id)
         return
 
-    result = execute_query(
+    result = await db.fetch(
         'SELECT code, last_request_at FROM verification_codes WHERE user_id = %s AND expires_at > NOW()',
-        (user_id,),
-        fetch=True
+        (user_id,)
     )
     is_expired = False
     if not result:
@@ -667,7 +2284,8 @@ async def process_code(message: types.Message, state: FSMContext):
     else:
         stored_code, _ = result[0]
         if input_code == stored_code:
-            execute_query('UPDATE users SET is_verified = TRUE WHERE user_id = %s', (user_id,))
+            await db.execute('UPDATE users SET is_verified = TRUE WHERE user_id = %s', (user_id,))
+            verified_users.set(user_id, True)
             await bot.edit_message_text(
                 chat_id=message.chat.id,
                 message_id=bot_message_id,
@@ -697,7 +2315,7 @@ async def process_code(message: types.Message, state: FSMContext):
         asyncio.create_task(delayed_edit_message(message.chat.id, bot_message_id, remaining, is_expired))
 
 async def get_resend_keyboard_and_status(user_id: int) -> tuple[InlineKeyboardMarkup, bool, float]:
-    result = execute_query('SELECT last_request_at FROM verification_codes WHERE user_id = %s', (user_id,), fetch=True)
+    result = await db.fetch('SELECT last_request_at FROM verification_codes WHERE user_id = %s', (user_id,))
     if result and result[0][0]:
         last_request_at = datetime.strptime(str(result[0][0]), "%Y-%m-%d %H:%M:%S")
         time_since_last_request = (datetime.now() - last_request_at).total_seconds()
@@ -723,7 +2341,7 @@ async def resend_verification_code(callback: types.CallbackQuery, state: FSMCont
         await callback.answer()
         return
 
-    result = execute_query('SELECT email, last_request_at FROM users u JOIN verification_codes v ON u.user_id = v.user_id WHERE u.user_id = %s', (user_id,), fetch=True)
+    result = await db.fetch('SELECT email, last_request_at FROM users u JOIN verification_codes v ON u.user_id = v.user_id WHERE u.user_id = %s', (user_id,))
     if not result:
         await callback.message.edit_text("❌ Пользователь не найден.", reply_markup=cancel_keyboard)
         await callback.answer()
@@ -742,7 +2360,7 @@ async def resend_verification_code(callback: types.CallbackQuery, state: FSMCont
     code = generate_verification_code()
     expires_at = datetime.now() + timedelta(minutes=10)
     last_request_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    execute_query(
+    await db.execute(
         'INSERT INTO verification_codes (user_id, code, expires_at, last_request_at) VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE code = %s, expires_at = %s, last_request_at = %s',
         (user_id, code, expires_at.strftime("%Y-%m-%d %H:%M:%S"), last_request_at, code, expires_at.strftime("%Y-%m-%d %H:%M:%S"), last_request_at)
     )
@@ -759,14 +2377,12 @@ async def resend_verification_code(callback: types.CallbackQuery, state: FSMCont
     await callback.answer()
 
 @dp.callback_query(F.data == "create_request")
-async def create_request_start(callback: types.CallbackQuery, state: FSMContext):
-    user_id = callback.from_user.id
-    result = execute_query('SELECT is_verified FROM users WHERE user_id = %s', (user_id,), fetch=True)
-    if not result or not result[0][0]:
+async def create_request_start(callback: types.CallbackQuery, state: FSMContext, is_verified: bool):
+    if not is_verified:
         await callback.message.edit_text("Вы не зарегистрированы. Используйте /start.")
         await callback.answer()
         return
-    await callback.message.edit_text("🙇‍♀️ Выберите категорию:", reply_markup=create_category_keyboard())
+    await callback.message.edit_text("🙇‍♀️ Выберите категорию:", reply_markup=category_keyboard)
     await state.update_data(bot_message_id=callback.message.message_id)
     await state.set_state(BotStates.create_category)
     await callback.answer()
@@ -774,10 +2390,8 @@ async def create_request_start(callback: types.CallbackQuery, state: FSMContext)
 @dp.callback_query(F.data.startswith("category_"))
 async def process_category(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
-    data_parts = callback.data.split("_")
-    category_id = data_parts[1]
-    timestamp = int(data_parts[2])
-    if time.time() - timestamp > 60:
+    category_id = callback.data.split("_")[1]
+    if is_keyboard_expired(callback):
         await callback.answer("❌ Это действие больше не актуально", show_alert=True)
         return
     category_name = next(name for name, id in CATEGORIES.items() if id == category_id)
@@ -830,6 +2444,7 @@ async def process_description(message: types.Message, state: FSMContext):
     await message.delete()
     data = await state.get_data()
     bot_message_id = data['bot_message_id']
+    media_downloads.discard(message.from_user.id)
     await state.update_data(description=message.text, media_files=[])
     await bot.edit_message_text(
         chat_id=message.chat.id,
@@ -844,36 +2459,22 @@ async def process_description(message: types.Message, state: FSMContext):
     )
     await state.set_state(BotStates.create_media)
 
-@dp.message(BotStates.create_media, F.photo | F.video | F.document)
-async def process_media(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    media_files = data.get('media_files', [])
-    file_info = None
-    file_name = None
-    if message.photo:
-        file_info = message.photo[-1]
-        file_name = f"photo_{file_info.file_id}.jpg"
-    elif message.video:
-        file_info = message.video
-        file_name = f"video_{file_info.file_id}.{message.video.mime_type.split('/')[-1]}"
-    elif message.document:
-        file_info = message.document
-        file_name = message.document.file_name or f"document_{file_info.file_id}"
-    
-    if file_info:
-        file_path = os.path.join(PHOTOS_DIR, file_name)
-        try:
-            file = await bot.get_file(file_info.file_id)
-            await bot.download_file(file.file_path, file_path)
-            media_files.append(file_path)
-            await state.update_data(media_files=media_files)
-            await message.delete()
-            success_message = await message.answer(f"✅ Файл добавлен")
-            asyncio.create_task(delete_after_delay(message.chat.id, success_message.message_id, 5))
-        except Exception as e:
-            logging.error(f"Ошибка при загрузке файла {file_name}: {e}")
-            error_message = await message.answer("❌ Ошибка при загрузке файла. Попробуйте снова.")
-            asyncio.create_task(delete_after_delay(message.chat.id, error_message.message_id, 5))
+@dp.message(BotStates.create_media, F.photo | F.video | F.document, flags={"album": True})
+async def process_media(message: types.Message, state: FSMContext, album: list[types.Message] | None = None):
+    messages = album or [message]
+    items = [item for item in map(media_item_from_message, messages) if item]
+
+    if items:
+        # Файлы скачиваются в фоне, подтверждение отправляется сразу — одно на весь альбом
+        data = await state.get_data()
+        media_files = data.get('media_files', [])
+        media_files.extend(items)
+        await state.update_data(media_files=media_files)
+        for item in items:
+            media_downloads.submit(message.from_user.id, item)
+        await delete_user_messages(message.chat.id, messages)
+        success_message = await message.answer(media_added_text(len(items)))
+        asyncio.create_task(delete_after_delay(message.chat.id, success_message.message_id, 5))
 
 @dp.message(BotStates.create_description)
 async def process_invalid_description(message: types.Message, state: FSMContext):
@@ -900,17 +2501,25 @@ priority_translation_map = {
     "High": "🏃‍♀️"
 }
 
+# Набор приоритетов меняется редко, поэтому клавиатура строится один раз на каждый вариант
+@lru_cache(maxsize=8)
+def build_priority_kb(priorities: tuple) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=priority_translation_map.get(name, name), callback_data=f"priority_{id}") for name, id in priorities],
+        [InlineKeyboardButton(text="↩️", callback_data="back_to_description")]
+    ])
+
 @dp.callback_query(F.data.startswith("priority_"))
 async def process_priority(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
-    data_parts = callback.data.split("_")
-    priority_id = data_parts[1]
-    timestamp = int(data_parts[2])
-    if time.time() - timestamp > 60:
+    priority_id = callback.data.split("_")[1]
+    if is_keyboard_expired(callback):
+        await callback.answer("❌ Это действие больше не актуально", show_alert=True)
+        return
+    priority_name = await priority_cache.name_by_id(priority_id)
+    if priority_name is None:
         await callback.answer("❌ Это действие больше не актуально", show_alert=True)
         return
-    priorities = await jira_client.get_priorities()
-    priority_name = next(name for name, id in priorities.items() if id == priority_id)
     await state.update_data(priority=priority_name)
     try:
         await callback.message.delete()
@@ -920,39 +2529,28 @@ async def process_priority(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     try:
         user_id = callback.from_user.id
-        user_email = execute_query('SELECT email FROM users WHERE user_id = %s', (user_id,), fetch=True)
+        user_email = await db.fetch('SELECT email FROM users WHERE user_id = %s', (user_id,))
         email = user_email[0][0] if user_email else "неизвестная почта"
-        issue_key = await jira_client.create_issue(
-            summary=data['title'],
-            description=data['description'],
-            priority=data['priority'],
-            email=email,
-            category_id=data['category_id']
-        )
-        data = await state.get_data()
-        media_files = data.get('media_files', [])
-        for file_path in media_files:
-            await jira_client.add_attachment(issue_key, file_path)
-            os.remove(file_path)
-        execute_query('''
-            INSERT INTO requests (user_id, issue_key, title, status, created_at, category)
-            VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP, %s)
-            ON DUPLICATE KEY UPDATE title = %s, status = %s, category = %s
-        ''', (callback.from_user.id, issue_key, data['title'], "To Do", data['category_name'], data['title'], "To Do", data['category_name']))
-        issue_url = f"{JIRA_URL}/browse/{issue_key}"
+        # Ключ привязан к сообщению диалога, поэтому двойное нажатие не создаст две заявки
+        idempotency_key = f"{user_id}-{data.get('bot_message_id') or uuid.uuid4().hex}"
+        await ticket_outbox.submit(idempotency_key, user_id, {
+            "title": data['title'],
+            "description": data['description'],
+            "priority": data['priority'],
+            "email": email,
+            "category_id": data['category_id'],
+            "category_name": data['category_name'],
+            "media_files": data.get('media_files', [])
+        })
         await progress_message.edit_text(
             "💆‍♂️  Главное меню  💆‍♀️",
             reply_markup=main_keyboard
         )
-        success_message = await callback.message.answer(
-            f"✅ Заявка успешно создана!\n"
-            f"🔑 Ключ: <code>{issue_key}</code>\n"
-            f"📊 Статус: Можете отслеживать в разделе 'Мои заявки'",
-            parse_mode="HTML"
-        )
-        await asyncio.sleep(3)
-        await success_message.delete()
+        accepted_message = await callback.message.answer("📨 Заявка принята и создаётся. Ключ заявки придёт отдельным сообщением")
+        asyncio.create_task(delete_after_delay(callback.message.chat.id, accepted_message.message_id, 5))
     except Exception as e:
+        # Заявка не попала в очередь — файлы черновика больше никому не нужны
+        discard_media(data.get('media_files', []))
         await progress_message.edit_text(f"❌ Ошибка: {str(e)}")
     finally:
         await state.clear()
@@ -980,25 +2578,27 @@ status_translation_map = {
 event_type_translation_map = {
     "comment_added": "комментарий",
     "status_changed": "статус",
-    "assignee_changed": "исполнитель"
+    "assignee_changed": "исполнитель",
+    "digest": "обновления"
 }
 
 @dp.callback_query(F.data == "my_requests")
-async def show_my_requests(callback: types.CallbackQuery, page: int = 1):
+async def show_my_requests(callback: types.CallbackQuery, page: str | int = 1, is_verified: bool | None = None):
     user_id = callback.from_user.id
-    result = execute_query('SELECT is_verified FROM users WHERE user_id = %s', (user_id,), fetch=True)
-    if not result or not result[0][0]:
+    if is_verified is None:
+        is_verified = await verified_users.is_verified(user_id)
+    if not is_verified:
         await callback.message.edit_text("Вы не зарегистрированы. Используйте /start.")
         await callback.answer()
         return
-    count = execute_query('''
-        SELECT COUNT(*) 
-        FROM requests 
-        WHERE user_id = %s 
-        AND (status != 'Done' OR created_at >= DATE_SUB(NOW(), INTERVAL 3 MONTH))
-    ''', (user_id,), fetch=True)[0][0]
-    count = min(count, 30)
-    if count == 0:
+    per_page = 5
+    page, requests, has_next = await fetch_keyset_page(
+        'SELECT issue_key, title, status, created_at, category FROM requests',
+        "user_id = %s AND (status != 'Done' OR created_at >= DATE_SUB(NOW(), INTERVAL 3 MONTH))",
+        (user_id,),
+        "created_at", "issue_key", page, per_page
+    )
+    if not requests:
         await callback.message.edit_text(
             "🙅‍♂️ У вас нет активных заявок 🙅‍♀️",
             parse_mode="HTML",
@@ -1006,21 +2606,16 @@ async def show_my_requests(callback: types.CallbackQuery, page: int = 1):
         )
         await callback.answer()
         return
-    per_page = 5
-    total_pages = (count + per_page - 1) // per_page
-    if page < 1:
-        page = 1
-    if page > total_pages:
-        page = total_pages
-    offset = (page - 1) * per_page
-    requests = execute_query('''
-        SELECT issue_key, title, status, created_at, category
-        FROM requests 
-        WHERE user_id = %s 
+    count = await approx_counts.get(("requests", user_id), '''
+        SELECT COUNT(*)
+        FROM requests
+        WHERE user_id = %s
         AND (status != 'Done' OR created_at >= DATE_SUB(NOW(), INTERVAL 3 MONTH))
-        ORDER BY created_at DESC
-        LIMIT %s OFFSET %s
-    ''', (user_id, per_page, offset), fetch=True)
+    ''', (user_id,))
+    total_pages = max((count + per_page - 1) // per_page, page + has_next)
+    first_key, _, _, first_created_at, _ = requests[0]
+    last_key, _, _, last_created_at, _ = requests[-1]
+    current_cursor = encode_page_cursor(page, "c", first_created_at, first_key)
     
     rows = []
     for issue_key, title, status, created_at, category in requests:
@@ -1030,20 +2625,22 @@ async def show_my_requests(callback: types.CallbackQuery, page: int = 1):
         button_text = f"{emoji} {issue_key} | {short_title} | {category} | {formatted_date}"
         rows.append([InlineKeyboardButton(
             text=button_text,
-            callback_data=f"task_{issue_key}_{int(time.time())}_{page}"
+            callback_data=f"task_{issue_key}_{current_cursor}"
         )])
     
-    if count > per_page:
+    if page > 1 or has_next:
         pagination_buttons = []
         if page > 1:
-            pagination_buttons.append(InlineKeyboardButton(text="👈", callback_data=f"request_page_{page-1}"))
-        pagination_buttons.append(InlineKeyboardButton(text=f"📖 {page}/{total_pages}", callback_data=f"request_page_{page}"))
-        if page < total_pages:
-            pagination_buttons.append(InlineKeyboardButton(text="👉", callback_data=f"request_page_{page+1}"))
+            prev_cursor = encode_page_cursor(page - 1, "b", first_created_at, first_key)
+            pagination_buttons.append(InlineKeyboardButton(text="👈", callback_data=f"request_page_{prev_cursor}"))
+        pagination_buttons.append(InlineKeyboardButton(text=f"📖 {page}/{total_pages}", callback_data=f"request_page_{current_cursor}"))
+        if has_next:
+            next_cursor = encode_page_cursor(page + 1, "a", last_created_at, last_key)
+            pagination_buttons.append(InlineKeyboardButton(text="👉", callback_data=f"request_page_{next_cursor}"))
         if pagination_buttons:
             rows.append(pagination_buttons)
     
-    if count > 0 and page == 1:
+    if page == 1:
         rows.append([
             InlineKeyboardButton(text="💡", callback_data="info_button"),
             InlineKeyboardButton(text="↩️", callback_data="back")
@@ -1059,6 +2656,11 @@ async def show_my_requests(callback: types.CallbackQuery, page: int = 1):
             reply_markup=keyboard
         )
     except Exception as e:
+        # Список не изменился, а кнопки ещё актуальны — сообщение оставляем как есть.
+        # Устаревший список пересоздаём: иначе у него не обновится дата и кнопки останутся просроченными
+        if is_message_not_modified(e) and not is_keyboard_expired(callback):
+            await callback.answer()
+            return
         logging.error(f"Ошибка при редактировании сообщения со списком заявок: {e}")
         await callback.message.delete()
         await bot.send_message(
@@ -1073,22 +2675,19 @@ async def info_button_handler(callback: types.CallbackQuery):
     await callback.answer("🔵 - К выполнению\n🟡 - В работе\n🟠 - Тестируется\n🔴 - Отменена\n⚪ - Приостановлена\n🟢 - Выполнена\n⚫ - В ожидании", show_alert=True)
 
 @dp.callback_query(F.data.startswith("request_page_"))
-async def request_page_handler(callback: types.CallbackQuery):
-    page = int(callback.data.split("_")[2])
-    await show_my_requests(callback, page)
+async def request_page_handler(callback: types.CallbackQuery, is_verified: bool):
+    page = callback.data.split("_", 2)[2]
+    await show_my_requests(callback, page, is_verified)
 
 @dp.callback_query(F.data.startswith("task_"))
 async def handle_task_click(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
-    parts = callback.data.split("_")
-    issue_key = parts[1]
-    timestamp = int(parts[2])
-    page = int(parts[3])
-    if time.time() - timestamp > 60:
+    _, issue_key, page = callback.data.split("_", 2)
+    if is_keyboard_expired(callback):
         await callback.answer("❌ Это действие больше не актуально", show_alert=True)
         return
     try:
-        issue_details = await jira_client.get_issue_details(issue_key)
+        issue_details = await issue_mirror.get_or_load(issue_key)
         if issue_details is None:
             error_msg = await bot.send_message(
                 chat_id=callback.from_user.id,
@@ -1099,12 +2698,10 @@ async def handle_task_click(callback: types.CallbackQuery, state: FSMContext):
             await show_my_requests(callback, page)
             return
 
-        # Комментарии (фильтруем служебного бота)
-        comments = await jira_client.get_issue_comments(issue_key)
-        filtered_comments = [c for c in comments if c["author"] != "WALL-E [robot]"]
-        if filtered_comments:
-            last_comment = filtered_comments[-1]["body"]
-            last_comment_author = filtered_comments[-1]["author"]
+        # Последний комментарий (служебный бот отфильтрован при записи в зеркало)
+        if issue_details["last_comment_author"]:
+            last_comment = issue_details["last_comment"]
+            last_comment_author = issue_details["last_comment_author"]
             last_comment_author_display = "Вас" if last_comment_author == "ORTP Bot" else last_comment_author
             comment_text = f"💬 Последний комментарий от <b>{last_comment_author_display}</b>: <b>{last_comment}</b>\n\n"
         else:
@@ -1157,6 +2754,7 @@ async def handle_task_click(callback: types.CallbackQuery, state: FSMContext):
             await state.update_data(task_message_id=task_message_id)
 
         # Важно: инициализируем хранилище комментария/файлов
+        media_downloads.discard(callback.from_user.id)
         await state.update_data(issue_key=issue_key, comment_text="", comment_files=[], page=page)
         await state.set_state(BotStates.add_comment)
 
@@ -1183,38 +2781,21 @@ async def process_invalid_media(message: types.Message, state: FSMContext):
 def _shift_index(idx: int, total: int, delta: int) -> int:
     return (idx + delta) % total
 
-@dp.message(BotStates.add_comment, F.photo | F.video | F.document)
-async def add_comment_media(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    media_files = data.get('comment_files', [])
-    file_info, file_name = None, None
+@dp.message(BotStates.add_comment, F.photo | F.video | F.document, flags={"album": True})
+async def add_comment_media(message: types.Message, state: FSMContext, album: list[types.Message] | None = None):
+    messages = album or [message]
+    items = [item for item in (media_item_from_message(m, prefix="comment_") for m in messages) if item]
 
-    if message.photo:
-        file_info = message.photo[-1]
-        file_name = f"comment_photo_{file_info.file_id}.jpg"
-    elif message.video:
-        file_info = message.video
-        ext = (message.video.mime_type.split('/')[-1] if message.video.mime_type else 'mp4')
-        file_name = f"comment_video_{file_info.file_id}.{ext}"
-    elif message.document:
-        file_info = message.document
-        file_name = message.document.file_name or f"comment_doc_{file_info.file_id}"
-
-    if file_info:
-        file_path = os.path.join(PHOTOS_DIR, file_name)
-        try:
-            file = await bot.get_file(file_info.file_id)
-            # (опционально) тут можно проверить размер file.file_size и отклонить > 20 Mb
-            await bot.download_file(file.file_path, file_path)
-            media_files.append(file_path)
-            await state.update_data(comment_files=media_files)
-            await message.delete()
-            ok = await message.answer("✅ Файл добавлен. Можете отправить ещё файл/текст или нажать «☑️».")
-            asyncio.create_task(delete_after_delay(message.chat.id, ok.message_id, 5))
-        except Exception as e:
-            logging.error(f"Ошибка при загрузке файла {file_name}: {e}")
-            err = await message.answer("❌ Не удалось загрузить файл. Попробуйте другой.")
-            asyncio.create_task(delete_after_delay(message.chat.id, err.message_id, 5))
+    if items:
+        data = await state.get_data()
+        media_files = data.get('comment_files', [])
+        media_files.extend(items)
+        await state.update_data(comment_files=media_files)
+        for item in items:
+            media_downloads.submit(message.from_user.id, item)
+        await delete_user_messages(message.chat.id, messages)
+        ok = await message.answer(f"{media_added_text(len(items))}. Можете отправить ещё файл/текст или нажать «☑️».")
+        asyncio.create_task(delete_after_delay(message.chat.id, ok.message_id, 5))
 
 
 @dp.callback_query(F.data.startswith("team_carousel_prev_"))
@@ -1224,7 +2805,7 @@ async def team_carousel_prev(callback: types.CallbackQuery, state: FSMContext):
     idx = data.get("carousel_index", 0)
     total = data.get("carousel_total", 1)
     new_idx = _shift_index(idx, total, -1)
-    members = get_team_members_full()
+    members = await team_roster.get()
     new_msg_id, is_media = await edit_member_message_or_send_new(callback.from_user.id, msg_id, members[new_idx], new_idx, total)
     await state.update_data(carousel_msg_id=new_msg_id, carousel_index=new_idx, carousel_is_media=is_media)
     await callback.answer()
@@ -1245,25 +2826,23 @@ async def team_carousel_next(callback: types.CallbackQuery, state: FSMContext):
     idx = data.get("carousel_index", 0)
     total = data.get("carousel_total", 1)
     new_idx = _shift_index(idx, total, +1)
-    members = get_team_members_full()
+    members = await team_roster.get()
     new_msg_id, is_media = await edit_member_message_or_send_new(callback.from_user.id, msg_id, members[new_idx], new_idx, total)
     await state.update_data(carousel_msg_id=new_msg_id, carousel_index=new_idx, carousel_is_media=is_media)
     await callback.answer()
 
 @dp.message(F.text == "/team")
-async def team_command(message: types.Message, state: FSMContext):
+async def team_command(message: types.Message, state: FSMContext, is_verified: bool):
     try:
         await message.delete()
     except Exception:
         pass
 
-    user_id = message.from_user.id
-    result = execute_query('SELECT is_verified FROM users WHERE user_id = %s', (user_id,), fetch=True)
-    if not result or not result[0][0]:
+    if not is_verified:
         await bot.send_message(chat_id=message.chat.id, text="Вы не зарегистрированы. Используйте /start.")
         return
 
-    members = get_team_members_full()
+    members = await team_roster.get()
     if not members:
         await bot.send_message(
             chat_id=message.chat.id,
@@ -1288,23 +2867,30 @@ async def team_command(message: types.Message, state: FSMContext):
     await state.set_state(BotStates.view_team_member)
 
 @dp.callback_query(F.data == "notifications")
-async def notifications_handler(callback: types.CallbackQuery):
-    await show_notifications(callback, 1)
+async def notifications_handler(callback: types.CallbackQuery, is_verified: bool):
+    await show_notifications(callback, 1, is_verified)
 
 @dp.callback_query(F.data.startswith("notif_page_"))
-async def notif_page_handler(callback: types.CallbackQuery):
-    page = int(callback.data.split("_")[2])
-    await show_notifications(callback, page)
+async def notif_page_handler(callback: types.CallbackQuery, is_verified: bool):
+    page = callback.data.split("_", 2)[2]
+    await show_notifications(callback, page, is_verified)
 
-async def show_notifications(callback: types.CallbackQuery, page: int = 1):
+async def show_notifications(callback: types.CallbackQuery, page: str | int = 1, is_verified: bool | None = None):
     user_id = callback.from_user.id
-    result = execute_query('SELECT is_verified FROM users WHERE user_id = %s', (user_id,), fetch=True)
-    if not result or not result[0][0]:
+    if is_verified is None:
+        is_verified = await verified_users.is_verified(user_id)
+    if not is_verified:
         await callback.message.edit_text("Вы не зарегистрированы. Используйте /start.")
         await callback.answer()
         return
-    count = execute_query('SELECT COUNT(*) FROM notifications WHERE user_id = %s', (user_id,), fetch=True)[0][0]
-    if count == 0:
+    per_page = 8
+    page, notifications, has_next = await fetch_keyset_page(
+        'SELECT id, issue_key, event_type, message_text, timestamp, is_read FROM notifications',
+        "user_id = %s",
+        (user_id,),
+        "timestamp", "id", page, per_page
+    )
+    if not notifications:
         try:
             await callback.message.edit_text(
                 "🙅‍♂️ У вас нет уведомлений 🙅‍♀️",
@@ -1325,33 +2911,26 @@ async def show_notifications(callback: types.CallbackQuery, page: int = 1):
             )
         await callback.answer()
         return
-    per_page = 8
-    total_pages = (count + per_page - 1) // per_page
-    if page < 1:
-        page = 1
-    if page > total_pages:
-        page = total_pages
-    offset = (page - 1) * per_page
-    notifications = execute_query('''
-        SELECT id, issue_key, event_type, message_text, timestamp, is_read 
-        FROM notifications 
-        WHERE user_id = %s 
-        ORDER BY timestamp DESC
-        LIMIT %s OFFSET %s
-    ''', (user_id, per_page, offset), fetch=True)
+    count = await approx_counts.get(("notifications", user_id), 'SELECT COUNT(*) FROM notifications WHERE user_id = %s', (user_id,))
+    total_pages = max((count + per_page - 1) // per_page, page + has_next)
+    first_id, _, _, _, first_timestamp, _ = notifications[0]
+    last_id, _, _, _, last_timestamp, _ = notifications[-1]
+    current_cursor = encode_page_cursor(page, "c", first_timestamp, first_id)
     rows = [
         [InlineKeyboardButton(
             text=f"{'🔘 ' if not is_read else ''}{issue_key} {event_type_translation_map.get(event_type, event_type)} {(datetime.strptime(str(timestamp), '%Y-%m-%d %H:%M:%S') + timedelta(hours=3)).strftime('%d.%m %H:%M')}",
-            callback_data=f"notif_{notif_id}_{int(time.time())}_{page}"
+            callback_data=f"notif_{notif_id}_{current_cursor}"
         )] for notif_id, issue_key, event_type, message_text, timestamp, is_read in notifications
     ]
-    if count > per_page:
+    if page > 1 or has_next:
         pagination_buttons = []
         if page > 1:
-            pagination_buttons.append(InlineKeyboardButton(text="👈", callback_data=f"notif_page_{page-1}"))
-        pagination_buttons.append(InlineKeyboardButton(text=f"📖 {page}/{total_pages}", callback_data=f"notif_page_{page}"))
-        if page < total_pages:
-            pagination_buttons.append(InlineKeyboardButton(text="👉", callback_data=f"notif_page_{page+1}"))
+            prev_cursor = encode_page_cursor(page - 1, "b", first_timestamp, first_id)
+            pagination_buttons.append(InlineKeyboardButton(text="👈", callback_data=f"notif_page_{prev_cursor}"))
+        pagination_buttons.append(InlineKeyboardButton(text=f"📖 {page}/{total_pages}", callback_data=f"notif_page_{current_cursor}"))
+        if has_next:
+            next_cursor = encode_page_cursor(page + 1, "a", last_timestamp, last_id)
+            pagination_buttons.append(InlineKeyboardButton(text="👉", callback_data=f"notif_page_{next_cursor}"))
         if pagination_buttons:
             rows.append(pagination_buttons)
     rows.append([InlineKeyboardButton(text="↩️", callback_data="back")])
@@ -1363,6 +2942,14 @@ async def show_notifications(callback: types.CallbackQuery, page: int = 1):
             parse_mode="HTML"
         )
     except Exception as e:
+        if is_message_not_modified(e):
+            if not is_keyboard_expired(callback):
+                await callback.answer()
+                return
+            try:
+                await callback.message.delete()
+            except Exception as delete_error:
+                logging.error(f"Не удалось удалить устаревший список уведомлений: {delete_error}")
         logging.error(f"Ошибка при редактировании сообщения со списком уведомлений: {e}")
         await bot.send_message(
             chat_id=callback.from_user.id,
@@ -1376,18 +2963,15 @@ async def show_notifications(callback: types.CallbackQuery, page: int = 1):
 async def delete_notification(callback: types.CallbackQuery):
     parts = callback.data.split("_")
     notif_id = parts[2]
-    page = int(parts[3])
+    page = parts[3]
     user_id = callback.from_user.id
     logging.info(f"Обработка callback notif_delete_{notif_id} для пользователя {user_id}")
     
-    execute_query('DELETE FROM notifications WHERE id = %s', (notif_id,))
+    await db.execute('DELETE FROM notifications WHERE id = %s', (notif_id,))
+    approx_counts.invalidate(("notifications", user_id))
     logging.info(f"Уведомление с ID {notif_id} удалено из базы")
     
-    count = execute_query(
-        'SELECT COUNT(*) FROM notifications WHERE user_id = %s',
-        (user_id,),
-        fetch=True
-    )[0][0]
+    count = await approx_counts.get(("notifications", user_id), 'SELECT COUNT(*) FROM notifications WHERE user_id = %s', (user_id,))
     
     if count == 0:
         try:
@@ -1410,10 +2994,7 @@ async def delete_notification(callback: types.CallbackQuery):
                 ])
             )
     else:
-        per_page = 8
-        total_pages = (count + per_page - 1) // per_page
-        if (page - 1) * per_page >= count:
-            page = total_pages
+        # Курсор включает опорную запись, поэтому опустевшая страница сама откатывается на первую
         await show_notifications(callback, page)
         logging.info(f"Остались другие уведомления, показан обновлённый список для пользователя {user_id}")
     
@@ -1421,11 +3002,10 @@ async def delete_notification(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data.startswith("notif_"))
 async def show_notification_details(callback: types.CallbackQuery):
-    parts = callback.data.split("_")
-    notif_id, timestamp, page = parts[1], parts[2], parts[3]
-    logging.info(f"Обработка callback notif_{notif_id}_{timestamp}")
-    if time.time() - int(timestamp) > 60:
-        logging.info(f"Callback notif_{notif_id}_{timestamp} устарел")
+    _, notif_id, page = callback.data.split("_", 2)
+    logging.info(f"Обработка callback notif_{notif_id}")
+    if is_keyboard_expired(callback):
+        logging.info(f"Callback notif_{notif_id} устарел")
         try:
             await callback.message.edit_text(
                 text="❌ Это действие больше не актуально",
@@ -1444,7 +3024,7 @@ async def show_notification_details(callback: types.CallbackQuery):
             )
         await callback.answer()
         return
-    notification = execute_query('SELECT message_text FROM notifications WHERE id = %s', (notif_id,), fetch=True)
+    notification = await db.fetch('SELECT message_text FROM notifications WHERE id = %s', (notif_id,))
     if not notification:
         logging.info(f"Уведомление с ID {notif_id} не найдено")
         try:
@@ -1466,7 +3046,7 @@ async def show_notification_details(callback: types.CallbackQuery):
         await callback.answer()
         return
     message_text = notification[0][0]
-    execute_query('UPDATE notifications SET is_read = TRUE WHERE id = %s', (notif_id,))
+    await db.execute('UPDATE notifications SET is_read = TRUE WHERE id = %s', (notif_id,))
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🗑️", callback_data=f"notif_delete_{notif_id}_{page}")],
         [InlineKeyboardButton(text="↩️", callback_data=f"notif_page_{page}")]
@@ -1493,7 +3073,7 @@ async def back_button_handler(callback: types.CallbackQuery, state: FSMContext):
 
 @dp.callback_query(F.data == "back_to_requests")
 async def back_to_requests_button_handler(callback: types.CallbackQuery, state: FSMContext):
-    await state.clear()
+    await abandon_draft(callback.from_user.id, state)
     await show_my_requests(callback, 1)
     await callback.answer()
 
@@ -1534,21 +3114,18 @@ async def media_done(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
     data = await state.get_data()
     bot_message_id = data['bot_message_id']
+    media_files, failed = await media_downloads.resolve(callback.from_user.id, data.get('media_files', []))
+    await state.update_data(media_files=media_files)
+    if failed:
+        error_message = await callback.message.answer(f"❌ Не удалось загрузить файлов: {failed}. Остальные будут прикреплены к заявке")
+        asyncio.create_task(delete_after_delay(callback.message.chat.id, error_message.message_id, 5))
     await state.set_state(BotStates.create_priority)
-    priorities = await jira_client.get_priorities()
-    buttons = [
-        InlineKeyboardButton(text=priority_translation_map.get(name, name), callback_data=f"priority_{id}_{int(time.time())}")
-        for name, id in priorities.items()
-    ]
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        buttons,
-        [InlineKeyboardButton(text="↩️", callback_data="back_to_description")]
-    ])
+    priorities = await priority_cache.get()
     await bot.edit_message_text(
         chat_id=callback.message.chat.id,
         message_id=bot_message_id,
         text="🧖‍♀️ Выберите приоритет:",
-        reply_markup=keyboard
+        reply_markup=build_priority_kb(tuple(priorities.items()))
     )
 
 @dp.callback_query(F.data == "comment_send")
@@ -1561,19 +3138,23 @@ async def comment_send(callback: types.CallbackQuery, state: FSMContext):
 
     progress = await callback.message.answer("⏳ Загружаю вложения и отправляю комментарий...")
     try:
-        # 1) Загружаем вложения
-        for path in files:
-            try:
-                await jira_client.add_attachment(issue_key, path)
-            finally:
-                if os.path.exists(path):
-                    os.remove(path)
+        # 1) Дожидаемся фоновых загрузок и загружаем вложения
+        files, failed = await media_downloads.resolve(callback.from_user.id, files)
+        try:
+            await upload_media(issue_key, files)
+        finally:
+            discard_media(files)
 
         # 2) Отправляем комментарий (если есть текст)
         if comment_text:
-            await jira_client.add_comment_to_issue(issue_key, comment_text)
-
-        await progress.edit_text(f"✅ Отправлено в {issue_key}")
+            known_status = await issue_mirror.fresh_status(issue_key, ISSUE_MIRROR_STATUS_FRESHNESS)
+            await jira_client.add_comment_to_issue(issue_key, comment_text, known_status=known_status)
+            await issue_mirror.record_comment(issue_key, comment_text, "ORTP Bot")
+
+        result_text = f"✅ Отправлено в {issue_key}"
+        if failed:
+            result_text += f"\n❌ Не удалось загрузить файлов: {failed}"
+        await progress.edit_text(result_text)
         asyncio.create_task(delete_after_delay(callback.message.chat.id, progress.message_id, 3))
 
         # Возврат в список заявок (или главное меню — на твой вкус)
@@ -1590,152 +3171,1294 @@ async def comment_send(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-async def jira_webhook_handler(request: web.Request):
+# === Состояние задач из webhook ===
+class IssueStateCache:
+    def __init__(self, ttl: int, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.jira_fetches = 0
+
+    def get(self, issue_key: str):
+        item = self._items.get(issue_key)
+        if item is None or item[1] < time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return item[0]
+
+    def put(self, issue_key: str, state: dict):
+        self._items[issue_key] = (state, time.monotonic() + self.ttl)
+        self._items.move_to_end(issue_key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    # Дополняет запись, не продлевая её: срок отсчитывается от последнего свежего статуса
+    def merge(self, issue_key: str, fields: dict):
+        item = self._items.get(issue_key)
+        if item is not None and item[1] >= time.monotonic():
+            self._items[issue_key] = ({**item[0], **fields}, item[1])
+
+    def stats(self) -> dict:
+        return {"size": len(self._items), "hits": self.hits, "misses": self.misses, "jira_fetches": self.jira_fetches}
+
+issue_state_cache = IssueStateCache(ttl=ISSUE_STATE_CACHE_TTL)
+
+def issue_state_from_payload(data: dict) -> dict:
+    # Поддерживаем как плоский формат нашего webhook, так и стандартное тело Jira (issue.fields)
+    fields = (data.get('issue') or {}).get('fields') or {}
+    status = data.get('status')
+    status = status.get('to') if isinstance(status, dict) else status
+    priority = data.get('priority')
+    priority = priority.get('name') if isinstance(priority, dict) else priority
+    state = {
+        "status": status or (fields.get('status') or {}).get('name'),
+        "summary": data.get('summary') or fields.get('summary'),
+        "priority": priority or (fields.get('priority') or {}).get('name')
+    }
+    return {key: value for key, value in state.items() if value}
+
+async def resolve_issue_state(issue_key: str, data: dict):
+    fresh = issue_state_from_payload(data)
+    state = {**(issue_state_cache.get(issue_key) or {}), **fresh}
+    # Кэш обновляем только данными из этого webhook: статус, взятый из самого кэша, не продлевает запись
+    if fresh.get("status"):
+        issue_state_cache.put(issue_key, state)
+    elif fresh:
+        issue_state_cache.merge(issue_key, fresh)
+    if state.get("status"):
+        return state
+    if WEBHOOK_ISSUE_STATE_SOURCE != "jira":
+        return state or None
     try:
-        secret = WEBHOOK_SECRET.encode('utf-8')
-        signature = request.headers.get('X-Hub-Signature')
-        if signature:
-            method, signature = signature.split('=')
-            body = await request.read()
-            expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
-            logging.info(f"Signature: {signature}, Expected: {expected}")
-            if not hmac.compare_digest(signature, expected):
-                logging.error("Неверная подпись webhook")
-                return web.Response(status=401)
-        
-        data = await request.json()
-        logging.info(f"Получен webhook: {data}")
+        issue_state_cache.jira_fetches += 1
+        state = await jira_client.get_issue_status(issue_key)
+        issue_state_cache.put(issue_key, state)
+        return state
+    except Exception as e:
+        # Недоступность Jira не должна терять уведомление: продолжаем с данными из webhook
+        logging.error(f"Ошибка при получении статуса/приоритета для {issue_key}: {e}")
+        return state or None
+
+# === Зеркало задач Jira ===
+# Карточка задачи строится из локальной копии: webhook обновляет её по событиям,
+# фоновая сверка перечитывает из Jira записи, которые давно не сверялись
+SERVICE_COMMENT_AUTHORS = ("WALL-E [robot]",)
+ISSUE_MIRROR_FIELDS = ("summary", "description", "assignee", "status", "priority", "created", "updated", "last_comment", "last_comment_author")
+
+def jira_timestamp() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000%z")
+
+class IssueMirror:
+    def __init__(self, reconcile_interval: int, stale_after: int, batch_size: int, concurrency: int):
+        self.reconcile_interval = reconcile_interval
+        self.stale_after = stale_after
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self._task = None
+        self.hits = 0
+        self.misses = 0
+        self.webhook_updates = 0
+        self.reconciled = 0
+        self.reconcile_failures = 0
+        self.deleted = 0
+
+    async def get(self, issue_key: str):
+        rows = await db.fetch(f'SELECT {", ".join(ISSUE_MIRROR_FIELDS)} FROM issue_mirror WHERE issue_key = %s', (issue_key,))
+        if not rows:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dict(zip(ISSUE_MIRROR_FIELDS, rows[0]))
+
+    # Для проверок перед записью в Jira статус берём из зеркала, только если оно сверялось недавно;
+    # None — статус нужно спросить у Jira
+    async def fresh_status(self, issue_key: str, max_age: int):
+        rows = await db.fetch(
+            'SELECT status FROM issue_mirror WHERE issue_key = %s AND synced_at >= DATE_SUB(NOW(), INTERVAL %s SECOND)',
+            (issue_key, max_age)
+        )
+        return rows[0][0] if rows else None
+
+    async def fetch_from_jira(self, issue_key: str):
+        # Комментарии служебного бота не показываем
+        return await jira_client.get_issue_view(issue_key, skip_authors=SERVICE_COMMENT_AUTHORS)
+
+    async def store(self, issue_key: str, issue: dict):
+        values = tuple(issue.get(field) for field in ISSUE_MIRROR_FIELDS)
+        await db.execute(f'''
+            INSERT INTO issue_mirror (issue_key, {", ".join(ISSUE_MIRROR_FIELDS)}, synced_at)
+            VALUES (%s, {", ".join(["%s"] * len(ISSUE_MIRROR_FIELDS))}, CURRENT_TIMESTAMP)
+            ON DUPLICATE KEY UPDATE {", ".join(f"{field} = VALUES({field})" for field in ISSUE_MIRROR_FIELDS)}, synced_at = CURRENT_TIMESTAMP
+        ''', (issue_key,) + values)
+
+    async def get_or_load(self, issue_key: str):
+        issue = await self.get(issue_key)
+        if issue is not None:
+            return issue
+        issue = await self.fetch_from_jira(issue_key)
+        if issue is not None:
+            await self.store(issue_key, issue)
+        return issue
+
+    # Частичное обновление: строки, которых ещё нет в зеркале, не создаются — их загрузит первый просмотр
+    async def update(self, issue_key: str, **fields):
+        fields = {field: value for field, value in fields.items() if field in ISSUE_MIRROR_FIELDS}
+        if not fields:
+            return
+        await db.execute(
+            f'UPDATE issue_mirror SET {", ".join(f"{field} = %s" for field in fields)} WHERE issue_key = %s',
+            tuple(fields.values()) + (issue_key,)
+        )
+
+    async def record_comment(self, issue_key: str, body: str, author: str):
+        if author in SERVICE_COMMENT_AUTHORS:
+            return
+        await self.update(issue_key, last_comment=body, last_comment_author=author, updated=jira_timestamp())
+
+    # Берём только поля из самого webhook: кэшированное состояние может быть старше, чем зеркало после сверки
+    async def apply_webhook(self, issue_key: str, event: str, data: dict):
+        fields = (data.get('issue') or {}).get('fields') or {}
+        changes = issue_state_from_payload(data)
+        if fields.get('description') is not None:
+            changes["description"] = fields['description']
+        changes["updated"] = fields.get('updated') or jira_timestamp()
+        if event == 'status_changed' and (data.get('status') or {}).get('to'):
+            changes["status"] = data['status']['to']
+        elif event == 'assignee_changed':
+            changes["assignee"] = (data.get('assignee') or {}).get('to') or 'Не назначен'
+        elif event == 'comment_added':
+            author = data.get('initiator_displayName', 'Неизвестный')
+            if author not in SERVICE_COMMENT_AUTHORS:
+                changes["last_comment"] = data.get('comment', 'Нет текста')
+                changes["last_comment_author"] = author
+        await self.update(issue_key, **changes)
+        self.webhook_updates += 1
+
+    async def _reconcile_one(self, issue_key: str, semaphore):
+        async with semaphore:
+            try:
+                issue = await self.fetch_from_jira(issue_key)
+            except Exception as e:
+                # synced_at не трогаем: запись останется устаревшей и будет сверена при следующем проходе
+                self.reconcile_failures += 1
+                logging.error(f"Ошибка сверки задачи {issue_key} с Jira: {e}")
+                return
+            if issue is None:
+                # Задача удалена в Jira (404) — убираем её из зеркала, иначе она перечитывалась бы каждый проход
+                await db.execute('DELETE FROM issue_mirror WHERE issue_key = %s', (issue_key,))
+                self.deleted += 1
+                return
+            await self.store(issue_key, issue)
+            self.reconciled += 1
+
+    async def reconcile_once(self):
+        rows = await db.fetch(
+            'SELECT issue_key FROM issue_mirror WHERE synced_at < DATE_SUB(NOW(), INTERVAL %s SECOND) ORDER BY synced_at LIMIT %s',
+            (self.stale_after, self.batch_size)
+        )
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*(self._reconcile_one(issue_key, semaphore) for (issue_key,) in rows))
 
-        event = data.get('event')
-        if not event:
-            logging.info("Webhook не содержит события")
-            return web.Response(status=200)
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            try:
+                await self.reconcile_once()
+            except Exception as e:
+                logging.error(f"Ошибка сверки зеркала задач: {e}")
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "webhook_updates": self.webhook_updates,
+            "reconciled": self.reconciled,
+            "reconcile_failures": self.reconcile_failures,
+            "deleted": self.deleted
+        }
 
-        issue_key = data.get('issue_key')
+issue_mirror = IssueMirror(
+    reconcile_interval=ISSUE_MIRROR_RECONCILE_INTERVAL,
+    stale_after=ISSUE_MIRROR_STALE_AFTER,
+    batch_size=ISSUE_MIRROR_RECONCILE_BATCH,
+    concurrency=ISSUE_MIRROR_RECONCILE_CONCURRENCY
+)
+
+# === Очередь создания заявок ===
+# Заявка сначала сохраняется в ticket_outbox, пользователь получает ответ сразу, а создание в Jira,
+# загрузку вложений и запись в requests выполняют фоновые воркеры с повторами.
+# Метка с ключом идемпотентности на задаче позволяет после сбоя найти уже созданную задачу, а не завести дубль
+class ClaimLostError(Exception):
+    pass
+
+class TicketOutbox:
+    def __init__(self, workers: int, max_attempts: int, poll_interval: float, claim_timeout: int):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+        self._active = {}
+        self.processing_time = LatencyStats()
+        self.submitted = 0
+        self.duplicates = 0
+        self.created = 0
+        self.partial = 0
+        self.retried = 0
+        self.failed = 0
+        self.claims_lost = 0
+
+    async def submit(self, idempotency_key: str, user_id: int, payload: dict):
+        # Повторное нажатие с тем же ключом не создаёт вторую запись
+        rowcount = await db.execute(
+            'INSERT IGNORE INTO ticket_outbox (idempotency_key, user_id, payload) VALUES (%s, %s, %s)',
+            (idempotency_key, user_id, json.dumps(payload, ensure_ascii=False))
+        )
+        if rowcount:
+            self.submitted += 1
+            self._wakeup.set()
+        else:
+            self.duplicates += 1
+
+    async def _claim(self):
+        token = str(uuid.uuid4())
+        claimed = await db.execute('''
+            UPDATE ticket_outbox
+            SET status = 'processing', claim_token = %s, claimed_at = NOW()
+            WHERE (status = 'pending' AND next_attempt_at <= NOW())
+               OR (status = 'processing' AND claimed_at < DATE_SUB(NOW(), INTERVAL %s SECOND))
+            ORDER BY id
+            LIMIT 1
+        ''', (token, self.claim_timeout))
+        if not claimed:
+            return None
+        rows = await db.fetch(
+            'SELECT id, idempotency_key, user_id, payload, issue_key, uploaded, attempts, claim_token FROM ticket_outbox WHERE claim_token = %s',
+            (token,)
+        )
+        return rows[0] if rows else None
+
+    # Все записи в строку — только пока она за этим воркером: после перехвата по claim_timeout
+    # прежний владелец должен остановиться, а не дублировать загрузки и сообщения пользователю
+    async def _update(self, outbox_id: int, token: str, assignments: str, params=()):
+        rowcount = await db.execute(
+            f'UPDATE ticket_outbox SET {assignments} WHERE id = %s AND claim_token = %s',
+            (*params, outbox_id, token)
+        )
+        # MySQL не считает строку изменённой, если значения совпали, поэтому владение проверяем отдельно
+        if not rowcount and not await db.fetch(
+            'SELECT 1 FROM ticket_outbox WHERE id = %s AND claim_token = %s', (outbox_id, token)
+        ):
+            raise ClaimLostError(f"Заявка из очереди #{outbox_id} уже обрабатывается другим воркером")
+
+    async def _heartbeat(self, outbox_id: int, token: str):
+        # Долгие загрузки не должны выглядеть зависшими: продлеваем захват задолго до claim_timeout
+        while True:
+            await asyncio.sleep(max(self.claim_timeout / 3, 1))
+            try:
+                await self._update(outbox_id, token, 'claimed_at = NOW()')
+            except ClaimLostError as e:
+                logging.warning(str(e))
+                return
+            except Exception as e:
+                logging.error(f"Не удалось продлить захват заявки #{outbox_id}: {e}")
+
+    def _retryable(self, error: Exception) -> bool:
+        # Сбои Jira/сети/БД повторяем с нарастающей паузой, ошибки самого запроса (4xx) — нет
+        return is_transient_error(error) or isinstance(error, (CircuitOpenError, mysql.connector.Error))
+
+    async def _process(self, row):
+        outbox_id, idempotency_key, user_id, payload, issue_key, uploaded, attempts, token = row
+        payload = json.loads(payload)
+        uploaded = json.loads(uploaded) if uploaded else []
+        label = f"ortp-{idempotency_key}"
         if not issue_key:
-            logging.info("Webhook не содержит ключа задачи")
-            return web.Response(status=200)
+            # Прошлый владелец мог создать задачу и не успеть сохранить ключ (сбой, перезапуск, перехват записи),
+            # поэтому сначала всегда ищем задачу по метке
+            if jira_client.labels_supported:
+                issue_key = await jira_client.find_issue_by_label(label)
+            if not issue_key:
+                issue_key = await jira_client.create_issue(
+                    summary=payload['title'],
+                    description=payload['description'],
+                    priority=payload['priority'],
+                    email=payload['email'],
+                    category_id=payload['category_id'],
+                    labels=[label]
+                )
+            await self._update(outbox_id, token, 'issue_key = %s', (issue_key,))
+        remaining = [item for item in payload['media_files'] if item["file_id"] not in uploaded]
+        failed_files = []
+        if remaining:
+            try:
+                await upload_media(issue_key, remaining, uploaded=uploaded)
+            except Exception as e:
+                if self._retryable(e) and attempts + 1 < self.max_attempts:
+                    raise
+                # Задача в Jira уже есть: незагруженный файл не отменяет заявку, иначе повторная отправка заведёт дубль
+                failed_files = [item["file_name"] for item in remaining if item["file_id"] not in uploaded]
+                logging.error(f"Заявка {issue_key} создана без {len(failed_files)} вложений: {e}")
+            finally:
+                await self._update(outbox_id, token, 'uploaded = %s', (json.dumps(uploaded),))
+        await db.execute('''
+            INSERT INTO requests (user_id, issue_key, title, status, created_at, category)
+            VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP, %s)
+            ON DUPLICATE KEY UPDATE title = %s, status = %s, category = %s
+        ''', (user_id, issue_key, payload['title'], "To Do", payload['category_name'], payload['title'], "To Do", payload['category_name']))
+        approx_counts.invalidate(("requests", user_id))
+        await self._update(
+            outbox_id, token, "status = 'done', claim_token = NULL, last_error = %s",
+            (f"Не загружены вложения: {', '.join(failed_files)}" if failed_files else None,)
+        )
+        discard_media(payload['media_files'])
+        self.created += 1
+        if failed_files:
+            self.partial += 1
+        text = (f"✅ Заявка успешно создана!\n"
+                f"🔑 Ключ: <code>{issue_key}</code>\n"
+                f"📊 Статус: Можете отслеживать в разделе 'Мои заявки'")
+        if failed_files:
+            text += "\n\n⚠️ Не удалось прикрепить файлы:\n" + "\n".join(f"• {html.escape(name)}" for name in failed_files)
+        try:
+            await bot.send_message(
+                chat_id=user_id,
+                text=text,
+                parse_mode="HTML",
+                reply_markup=hide_notification_keyboard
+            )
+        except Exception as e:
+            logging.error(f"Не удалось сообщить пользователю {user_id} о заявке {issue_key}: {e}")
+
+    async def _handle_failure(self, row, error: Exception):
+        outbox_id, _, user_id, payload, _, _, attempts, token = row
+        attempts += 1
+        if self._retryable(error) and attempts < self.max_attempts:
+            self.retried += 1
+            delay = min(10 * 2 ** (attempts - 1), 600)
+            logging.warning(f"Заявка из очереди #{outbox_id}: попытка {attempts} не удалась ({error}), повтор через {delay} с")
+            await self._update(
+                outbox_id, token,
+                "status = 'pending', attempts = %s, last_error = %s, claim_token = NULL, next_attempt_at = DATE_ADD(NOW(), INTERVAL %s SECOND)",
+                (attempts, str(error), delay)
+            )
+            return
+        logging.error(f"Заявка из очереди #{outbox_id} не создана после {attempts} попыток: {error}")
+        await self._update(
+            outbox_id, token, "status = 'failed', attempts = %s, last_error = %s, claim_token = NULL",
+            (attempts, str(error))
+        )
+        self.failed += 1
+        payload = json.loads(payload)
+        discard_media(payload['media_files'])
+        try:
+            await bot.send_message(
+                chat_id=user_id,
+                text=f"❌ Не удалось создать заявку «{payload['title']}»: {error}\nПопробуйте создать её снова.",
+                reply_markup=hide_notification_keyboard
+            )
+        except Exception as e:
+            logging.error(f"Не удалось сообщить пользователю {user_id} об ошибке заявки: {e}")
+
+    async def _worker(self):
+        while True:
+            try:
+                row = await self._claim()
+            except Exception as e:
+                logging.error(f"Ошибка выборки из очереди заявок: {e}")
+                row = None
+            if row is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            outbox_id, token = row[0], row[-1]
+            self._active[outbox_id] = token
+            heartbeat = asyncio.create_task(self._heartbeat(outbox_id, token))
+            started = time.monotonic()
+            try:
+                await self._process(row)
+            except ClaimLostError as e:
+                self.claims_lost += 1
+                logging.warning(f"{e}, попытка прекращена")
+            except Exception as e:
+                try:
+                    await self._handle_failure(row, e)
+                except ClaimLostError as lost:
+                    self.claims_lost += 1
+                    logging.warning(f"{lost}, результат попытки не сохранён")
+                except Exception as db_error:
+                    # Запись останется в processing и будет забрана снова по claim_timeout
+                    logging.error(f"Не удалось сохранить результат попытки для заявки #{outbox_id}: {db_error}")
+            finally:
+                heartbeat.cancel()
+                self._active.pop(outbox_id, None)
+            self.processing_time.observe(time.monotonic() - started)
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        active = dict(self._active)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        # Прерванные записи сразу возвращаем в очередь, не дожидаясь claim_timeout
+        for outbox_id, token in active.items():
+            try:
+                await db.execute(
+                    "UPDATE ticket_outbox SET status = 'pending', claim_token = NULL WHERE id = %s AND claim_token = %s",
+                    (outbox_id, token)
+                )
+            except Exception as e:
+                logging.error(f"Не удалось вернуть заявку #{outbox_id} в очередь: {e}")
+        self._active.clear()
+
+    def stats(self) -> dict:
+        return {
+            "active": len(self._active),
+            "submitted": self.submitted,
+            "duplicates": self.duplicates,
+            "created": self.created,
+            "partial": self.partial,
+            "retried": self.retried,
+            "failed": self.failed,
+            "claims_lost": self.claims_lost,
+            "processing_time": self.processing_time.snapshot()
+        }
 
-        result = execute_query(
-            'SELECT user_id, status FROM requests WHERE issue_key = %s',
-            (issue_key,), fetch=True
+ticket_outbox = TicketOutbox(
+    workers=TICKET_OUTBOX_WORKERS,
+    max_attempts=TICKET_OUTBOX_MAX_ATTEMPTS,
+    poll_interval=TICKET_OUTBOX_POLL_INTERVAL,
+    claim_timeout=TICKET_OUTBOX_CLAIM_TIMEOUT
+)
+
+# === Сверка статусов заявок ===
+# Пропущенный webhook иначе навсегда оставит в requests старый статус. Раз в interval
+# одним JQL-поиском забираем задачи проекта, изменённые с прошлой сверки, и обновляем статусы пачками
+class StatusSync:
+    def __init__(self, interval: int, initial_days: int, page_size: int, update_batch: int, overlap_minutes: int = 2):
+        self.interval = interval
+        self.initial_days = initial_days
+        self.page_size = page_size
+        self.update_batch = update_batch
+        self.overlap_minutes = overlap_minutes
+        self._task = None
+        self.runs = 0
+        self.pages = 0
+        self.issues_seen = 0
+        self.requests_updated = 0
+        self.duration = LatencyStats(size=100)
+
+    async def _last_sync(self):
+        rows = await db.fetch("SELECT value FROM sync_state WHERE name = 'status_sync'")
+        return float(rows[0][0]) if rows else None
+
+    async def _save_last_sync(self, moment: float):
+        await db.execute(
+            "INSERT INTO sync_state (name, value) VALUES ('status_sync', %s) ON DUPLICATE KEY UPDATE value = %s",
+            (str(moment), str(moment))
         )
-        if not result:
-            logging.info(f"Задача {issue_key} не найдена в базе")
-            return web.Response(status=200)
-        user_id, last_status = result[0]
 
+    # Относительная дата в JQL не зависит от часового пояса пользователя Jira
+    def _jql(self, since_minutes: int):
+        return f'project = {jira_client.project_key} AND updated >= "-{since_minutes}m" ORDER BY updated ASC, key ASC'
+
+    async def _apply_mirror(self, changes: list):
+        # Одним UPDATE на пачку: CASE подставляет каждой задаче её статус и время обновления
+        for i in range(0, len(changes), self.update_batch):
+            chunk = changes[i:i + self.update_batch]
+            cases = " ".join(["WHEN %s THEN %s"] * len(chunk))
+            params = [value for key, status, _ in chunk for value in (key, status)]
+            params += [value for key, _, updated_at in chunk for value in (key, updated_at)]
+            params += [key for key, _, _ in chunk]
+            await db.execute(f'''
+                UPDATE issue_mirror
+                SET status = CASE issue_key {cases} END, updated = CASE issue_key {cases} END
+                WHERE issue_key IN ({", ".join(["%s"] * len(chunk))})
+            ''', tuple(params))
+
+    async def _apply_requests(self, changes: list, notify: bool):
+        # Пачка заявок блокируется SELECT ... FOR UPDATE, изменившиеся статусы пишутся одним UPDATE с CASE.
+        # Webhook меняет статус условно (WHERE status <=> прежний), поэтому переход, уже применённый здесь,
+        # он не применит и не уведомит повторно — и наоборот
+        updated = 0
+        for i in range(0, len(changes), self.update_batch):
+            chunk = changes[i:i + self.update_batch]
+            new_statuses = {key: status for key, status, _ in chunk}
+            async with db.transaction() as cursor:
+                await cursor.execute(
+                    f'SELECT issue_key, user_id, status FROM requests WHERE issue_key IN ({", ".join(["%s"] * len(chunk))}) FOR UPDATE',
+                    tuple(new_statuses)
+                )
+                changed = [
+                    (issue_key, user_id, old_status, new_statuses[issue_key])
+                    for issue_key, user_id, old_status in await cursor.fetchall()
+                    if new_statuses[issue_key] != old_status
+                ]
+                if changed:
+                    await cursor.execute(f'''
+                        UPDATE requests
+                        SET status = CASE issue_key {" ".join(["WHEN %s THEN %s"] * len(changed))} END
+                        WHERE issue_key IN ({", ".join(["%s"] * len(changed))})
+                    ''', tuple(value for key, _, _, status in changed for value in (key, status)) + tuple(key for key, _, _, _ in changed))
+            updated += len(changed)
+            if not notify:
+                continue
+            for issue_key, user_id, old_status, new_status in changed:
+                if should_notify():
+                    await notification_coalescer.submit(
+                        user_id, issue_key, 'status_changed', status_change_text(issue_key, old_status, new_status)
+                    )
+        return updated
+
+    async def run_once(self):
+        started = time.monotonic()
+        run_started_at = time.time()
+        last_sync = await self._last_sync()
+        if last_sync is None:
+            since = self.initial_days * 24 * 60
+        else:
+            since = int((run_started_at - last_sync) // 60) + self.overlap_minutes
+        start_at = 0
+        seen = set()
+        updated = 0
+        while True:
+            page = await jira_client.search_issues(self._jql(since), ["status", "updated"], start_at=start_at, max_results=self.page_size)
+            issues = page.get("issues", [])
+            self.pages += 1
+            # После перезапуска окна часть задач приходит повторно — применяем каждое изменение один раз
+            changes = []
+            for issue in issues:
+                change = (issue["key"], issue["fields"]["status"]["name"], issue["fields"].get("updated"))
+                if change not in seen:
+                    seen.add(change)
+                    changes.append(change)
+            self.issues_seen += len(changes)
+            if changes:
+                # Первая сверка просматривает initial_days назад: о давно закрытых заявках не уведомляем
+                updated += await self._apply_requests(changes, notify=last_sync is not None)
+                await self._apply_mirror(changes)
+            if not issues or start_at + len(issues) >= page.get("total", 0):
+                break
+            # Следующую страницу запрашиваем от последнего увиденного updated, а не смещением:
+            # задача, обновлённая во время обхода, уходит в конец выдачи и сдвигает startAt, пропуская соседнюю
+            last_updated = issues[-1]["fields"].get("updated")
+            next_since = None
+            if last_updated:
+                moment = datetime.strptime(last_updated, "%Y-%m-%dT%H:%M:%S.%f%z").timestamp()
+                next_since = int((time.time() - moment) // 60) + 1
+            if next_since is not None and next_since < since:
+                since, start_at = next_since, 0
+            else:
+                # Вся страница в пределах одной минуты — окно не сдвинуть, листаем внутри него
+                start_at += len(issues)
+        await self._save_last_sync(run_started_at)
+        self.runs += 1
+        self.requests_updated += updated
+        self.duration.observe(time.monotonic() - started)
+        logging.info(f"Сверка статусов: просмотрено {len(seen)} задач, обновлено заявок {updated}")
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logging.error(f"Ошибка сверки статусов заявок: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "pages": self.pages,
+            "issues_seen": self.issues_seen,
+            "requests_updated": self.requests_updated,
+            "duration": self.duration.snapshot()
+        }
+
+status_sync = StatusSync(
+    interval=STATUS_SYNC_INTERVAL,
+    initial_days=STATUS_SYNC_INITIAL_DAYS,
+    page_size=STATUS_SYNC_PAGE_SIZE,
+    update_batch=STATUS_SYNC_UPDATE_BATCH
+)
+
+# === Доставка уведомлений ===
+def status_change_text(issue_key: str, from_status: str, to_status: str) -> str:
+    from_translated = status_translation_map.get(from_status, from_status)
+    to_translated = status_translation_map.get(to_status, to_status)
+    return f"🙋‍♀️ Статус вашей заявки 🔑{issue_key} изменился с '{from_translated}' на '{to_translated}'"
+
+def comment_reply_hint(issue_key: str) -> str:
+    return f"\n\nЕсли хотите ответить - перейдите в раздел \"Мои заявки\" и выберите заявку 🔑{issue_key}."
+
+# Telegram считает длину сообщения в кодовых единицах UTF-16: эмодзи занимают две
+def telegram_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+def truncate_text(text: str, limit: int) -> str:
+    if telegram_len(text) <= limit:
+        return text
+    return text.encode("utf-16-le")[:(limit - 1) * 2].decode("utf-16-le", errors="ignore") + "…"
+
+async def deliver_notification(user_id: int, issue_key: str, event_type: str, message_text: str):
+    await bot.send_message(chat_id=user_id, text=message_text, parse_mode="HTML", reply_markup=hide_notification_keyboard)
+    await db.execute(
+        'INSERT INTO notifications (user_id, issue_key, event_type, message_text) VALUES (%s, %s, %s, %s)',
+        (user_id, issue_key, event_type, message_text)
+    )
+    approx_counts.invalidate(("notifications", user_id))
+    logging.info(f"Отправлено уведомление ({event_type}) для {issue_key} пользователю {user_id}")
+
+# С persist каждое событие до доставки лежит в notification_outbox: уведомление, ожидающее окна объединения,
+# переживает падение процесса. Строки остановившейся реплики забирает и доставляет любая живая
+class NotificationCoalescer:
+    def __init__(self, deliver, window: float, entry_limit: int, persist: bool, recover_interval: int = 60):
+        self.deliver = deliver
+        self.window = window
+        self.entry_limit = entry_limit
+        self.persist = persist
+        self.recover_interval = recover_interval
+        self.owner = str(uuid.uuid4())
+        self._pending = {}
+        self._timers = {}
+        self._recover_task = None
+        self.events_in = 0
+        self.messages_out = 0
+        self.recovered = 0
+
+    async def submit(self, user_id: int, issue_key: str, event_type: str, message_text: str):
+        self.events_in += 1
+        row_id = None
+        if self.persist:
+            row_id = await db.insert(
+                'INSERT INTO notification_outbox (user_id, issue_key, event_type, message_text, owner) VALUES (%s, %s, %s, %s, %s)',
+                (user_id, issue_key, event_type, message_text, self.owner)
+            )
+        event = (event_type, message_text, row_id)
+        if self.window <= 0:
+            await self._send((user_id, issue_key), [event])
+            return
+        key = (user_id, issue_key)
+        if key in self._pending:
+            self._pending[key].append(event)
+            return
+        self._pending[key] = [event]
+        self._timers[key] = asyncio.create_task(self._flush_later(key))
+
+    async def _flush_later(self, key):
+        await asyncio.sleep(self.window)
+        self._timers.pop(key, None)
+        await self._flush(key)
+
+    async def _flush(self, key):
+        events = self._pending.pop(key, None)
+        if not events:
+            return
+        outbound_lane.set(LANE_BULK)
         try:
-            issue_info = await jira_client.get_issue_status(issue_key)
-            current_status = issue_info['status']
-            priority = issue_info['priority']
+            await self._send(key, events)
         except Exception as e:
-            logging.error(f"Ошибка при получении статуса/приоритета для {issue_key}: {e}")
-            return web.Response(status=200)
-
-        if event == 'status_changed':
-            from_status = data.get('status', {}).get('from', 'Неизвестно')
-            to_status = data.get('status', {}).get('to', 'Неизвестно')
-            from_translated = status_translation_map.get(from_status, from_status)
-            to_translated = status_translation_map.get(to_status, to_status)
-            if to_status == last_status:
-                logging.info(f"Статус задачи {issue_key} не изменился")
-                return web.Response(status=200)
-            if should_notify():
-                message_text = f"🙋‍♀️ Статус вашей заявки 🔑{issue_key} изменился с '{from_translated}' на '{to_translated}'"
-                sent_message = await bot.send_message(chat_id=user_id, text=message_text, parse_mode="HTML", reply_markup=hide_notification_keyboard)
-                execute_query(
-                    'INSERT INTO notifications (user_id, issue_key, event_type, message_text) VALUES (%s, %s, %s, %s)',
-                    (user_id, issue_key, event, message_text)
+            logging.error(f"Ошибка доставки уведомления для {key[1]} пользователю {key[0]}: {e}")
+
+    async def _send(self, key, events: list):
+        user_id, issue_key = key
+        try:
+            await self._deliver(user_id, issue_key, [(event_type, message_text) for event_type, message_text, _ in events])
+        finally:
+            # Строку убираем и после неудачной отправки: повторять её бесконечно (например, бот заблокирован) незачем
+            row_ids = [row_id for _, _, row_id in events if row_id is not None]
+            if row_ids:
+                await db.execute(
+                    f'DELETE FROM notification_outbox WHERE id IN ({", ".join(["%s"] * len(row_ids))})', tuple(row_ids)
                 )
-                execute_query(
-                    '''
-                    DELETE n
-                    FROM notifications n
-                    LEFT JOIN (
-                        SELECT id
-                        FROM notifications
-                        WHERE user_id = %s
-                        ORDER BY timestamp DESC
-                        LIMIT 100
-                    ) AS keep ON n.id = keep.id
-                    WHERE n.user_id = %s
-                    AND keep.id IS NULL
-                    ''', (user_id, user_id))
-                logging.info(f"Отправлено уведомление о смене статуса для {issue_key} пользователю {user_id}")
-            execute_query('UPDATE requests SET status = %s WHERE issue_key = %s', (to_status, issue_key))
-        
-        elif event == 'comment_added':
-            initiator = data.get('initiator', 'Неизвестный')
-            initiator_displayName = data.get('initiator_displayName', 'Неизвестный')
-            comment = data.get('comment', 'Нет текста')
-            if initiator != 'ortp_bot' and should_notify():
-                message_text = f"💁‍♀️ Новый комментарий к вашей заявке 🔑{issue_key} от 👩‍💼 {initiator_displayName}: {comment}. \n\nЕсли хотите ответить - перейдите в раздел \"Мои заявки\" и выберите заявку 🔑{issue_key}."
-                sent_message = await bot.send_message(chat_id=user_id, text=message_text, parse_mode="HTML", reply_markup=hide_notification_keyboard)
-                execute_query(
-                    'INSERT INTO notifications (user_id, issue_key, event_type, message_text) VALUES (%s, %s, %s, %s)',
-                    (user_id, issue_key, event, message_text)
+
+    async def recover_once(self):
+        # Чужие строки старше окна с запасом — реплика, которая их держала, остановилась
+        claimed = await db.execute('''
+            UPDATE notification_outbox SET owner = %s
+            WHERE (owner IS NULL OR owner != %s) AND created_at < DATE_SUB(NOW(), INTERVAL %s SECOND)
+        ''', (self.owner, self.owner, int(self.window) + self.recover_interval))
+        if not claimed:
+            return
+        held = {row_id for events in self._pending.values() for _, _, row_id in events}
+        rows = await db.fetch(
+            'SELECT id, user_id, issue_key, event_type, message_text FROM notification_outbox WHERE owner = %s ORDER BY id',
+            (self.owner,)
+        )
+        groups = {}
+        for row_id, user_id, issue_key, event_type, message_text in rows:
+            if row_id not in held:
+                groups.setdefault((user_id, issue_key), []).append((event_type, message_text, row_id))
+        outbound_lane.set(LANE_BULK)
+        for key, events in groups.items():
+            self.recovered += len(events)
+            try:
+                await self._send(key, events)
+            except Exception as e:
+                logging.error(f"Ошибка доставки восстановленного уведомления для {key[1]} пользователю {key[0]}: {e}")
+
+    async def _recover_loop(self):
+        while True:
+            try:
+                await self.recover_once()
+            except Exception as e:
+                logging.error(f"Ошибка восстановления уведомлений: {e}")
+            await asyncio.sleep(self.recover_interval)
+
+    def start(self):
+        if self.persist:
+            self._recover_task = asyncio.create_task(self._recover_loop())
+
+    async def _deliver(self, user_id: int, issue_key: str, events: list):
+        if len(events) == 1:
+            event_type, message_text = events[0]
+            hint = comment_reply_hint(issue_key)
+            if message_text.endswith(hint):
+                message_text = truncate_text(message_text.removesuffix(hint), TELEGRAM_MESSAGE_LIMIT - telegram_len(hint)) + hint
+            else:
+                message_text = truncate_text(message_text, TELEGRAM_MESSAGE_LIMIT)
+        else:
+            # Несколько быстрых событий по одной заявке уходят одним сообщением и одной строкой в notifications
+            event_type = "digest"
+            message_text = self._digest(issue_key, [text for _, text in events])
+        await self.deliver(user_id, issue_key, event_type, message_text)
+        self.messages_out += 1
+
+    # Подсказка об ответе выносится в конец один раз, каждое событие обрезается,
+    # а не поместившиеся в лимит Telegram сворачиваются в счётчик
+    def _digest(self, issue_key: str, texts: list) -> str:
+        hint = comment_reply_hint(issue_key)
+        footer = hint if any(text.endswith(hint) for text in texts) else ""
+        entries = [truncate_text(text.removesuffix(hint), self.entry_limit) for text in texts]
+
+        def more(count: int) -> str:
+            return f"\n\n…и ещё обновлений: {count}"
+
+        message_text = f"🔔 Обновления по вашей заявке 🔑{issue_key}:"
+        for index, entry in enumerate(entries):
+            remaining = len(entries) - index
+            reserve = telegram_len(more(remaining - 1)) if remaining > 1 else 0
+            if telegram_len(message_text + entry + footer) + 2 + reserve > TELEGRAM_MESSAGE_LIMIT:
+                message_text += more(remaining)
+                break
+            message_text += "\n\n" + entry
+        return message_text + footer
+
+    async def stop(self):
+        if self._recover_task:
+            self._recover_task.cancel()
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        for key in list(self._pending):
+            await self._flush(key)
+
+    def stats(self) -> dict:
+        return {
+            "window_s": self.window,
+            "pending": len(self._pending),
+            "events_in": self.events_in,
+            "messages_out": self.messages_out,
+            "recovered": self.recovered
+        }
+
+notification_coalescer = NotificationCoalescer(
+    deliver_notification,
+    window=NOTIFICATION_DIGEST_WINDOW,
+    entry_limit=NOTIFICATION_DIGEST_ENTRY_LIMIT,
+    persist=WEBHOOK_QUEUE_PERSIST
+)
+
+# === Очистка старых уведомлений ===
+class NotificationRetention:
+    def __init__(self, interval: int, max_per_user: int, max_age_days: int, batch_size: int):
+        self.interval = interval
+        self.max_per_user = max_per_user
+        self.max_age_days = max_age_days
+        self.batch_size = batch_size
+        self._task = None
+        self.runs = 0
+        self.deleted_by_age = 0
+        self.deleted_by_limit = 0
+        self.duration = LatencyStats(size=100)
+
+    # Удаляем пачками по batch_size, чтобы не держать длинные блокировки на таблице
+    async def _delete_in_batches(self, query, params) -> int:
+        deleted = 0
+        while True:
+            rowcount = await db.execute(query + ' LIMIT %s', params + (self.batch_size,))
+            deleted += rowcount
+            if rowcount < self.batch_size:
+                return deleted
+
+    async def run_once(self):
+        started = time.monotonic()
+        if self.max_age_days > 0:
+            self.deleted_by_age += await self._delete_in_batches(
+                'DELETE FROM notifications WHERE timestamp < DATE_SUB(NOW(), INTERVAL %s DAY)',
+                (self.max_age_days,)
+            )
+        if self.max_per_user > 0:
+            users = await db.fetch(
+                'SELECT user_id FROM notifications GROUP BY user_id HAVING COUNT(*) > %s',
+                (self.max_per_user,)
+            )
+            for (user_id,) in users:
+                cutoff = await db.fetch('''
+                    SELECT timestamp, id
+                    FROM notifications
+                    WHERE user_id = %s
+                    ORDER BY timestamp DESC, id DESC
+                    LIMIT 1 OFFSET %s
+                ''', (user_id, self.max_per_user - 1))
+                if not cutoff:
+                    continue
+                cutoff_timestamp, cutoff_id = cutoff[0]
+                self.deleted_by_limit += await self._delete_in_batches(
+                    'DELETE FROM notifications WHERE user_id = %s AND (timestamp < %s OR (timestamp = %s AND id < %s))',
+                    (user_id, cutoff_timestamp, cutoff_timestamp, cutoff_id)
                 )
-                execute_query(
-                    '''
-                    DELETE n
-                    FROM notifications n
-                    LEFT JOIN (
-                        SELECT id
-                        FROM notifications
-                        WHERE user_id = %s
-                        ORDER BY timestamp DESC
-                        LIMIT 100
-                    ) AS keep ON n.id = keep.id
-                    WHERE n.user_id = %s
-                    AND keep.id IS NULL
-                    ''', (user_id, user_id))
-                logging.info(f"Отправлено уведомление о новом комментарии для {issue_key} пользователю {user_id}")
-        
-        elif event == 'assignee_changed':
-            from_assignee = data.get('assignee', {}).get('from', 'Не назначен')
-            to_assignee = data.get('assignee', {}).get('to', 'Не назначен') or 'Не назначен'
-            if should_notify():
-                message_text = f"👩‍💼 Новый исполнитель вашей заявки 🔑{issue_key} - 🙋‍♀️ {to_assignee}"
-                sent_message = await bot.send_message(chat_id=user_id, text=message_text, parse_mode="HTML", reply_markup=hide_notification_keyboard)
-                execute_query(
-                    'INSERT INTO notifications (user_id, issue_key, event_type, message_text) VALUES (%s, %s, %s, %s)',
-                    (user_id, issue_key, event, message_text)
+        self.runs += 1
+        self.duration.observe(time.monotonic() - started)
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logging.error(f"Ошибка очистки уведомлений: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "deleted_by_age": self.deleted_by_age,
+            "deleted_by_limit": self.deleted_by_limit,
+            "duration": self.duration.snapshot()
+        }
+
+notification_retention = NotificationRetention(
+    interval=NOTIFICATIONS_RETENTION_INTERVAL,
+    max_per_user=NOTIFICATIONS_MAX_PER_USER,
+    max_age_days=NOTIFICATIONS_MAX_AGE_DAYS,
+    batch_size=NOTIFICATIONS_RETENTION_BATCH
+)
+
+# === Очередь входящих webhook ===
+# События раскладываются по воркерам по ключу задачи: события одной задачи обрабатываются
+# одним воркером строго по порядку, разные задачи — параллельно.
+# С persist события хранятся в webhook_events с владельцем-репликой: живая реплика продлевает захват,
+# строки упавшей реплики и неудачные события забираются заново по claim_timeout
+class WebhookQueue:
+    def __init__(self, handler, maxsize: int, workers: int, enqueue_timeout: float, persist: bool,
+                 drain_timeout: float, claim_timeout: int, max_attempts: int):
+        self.handler = handler
+        self.workers = workers
+        self.queues = [asyncio.Queue(maxsize=max(maxsize // workers, 1)) for _ in range(workers)]
+        self.enqueue_timeout = enqueue_timeout
+        self.persist = persist
+        self.drain_timeout = drain_timeout
+        self.claim_timeout = claim_timeout
+        self.max_attempts = max_attempts
+        self.owner = str(uuid.uuid4())
+        self._tasks = []
+        self._claim_task = None
+        self._held = set()
+        self.lag = LatencyStats()
+        self.processing_time = LatencyStats()
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.restored = 0
+        self.dropped = 0
+
+    def _partition(self, data: dict) -> asyncio.Queue:
+        return self.queues[hash(data.get('issue_key') or '') % self.workers]
+
+    async def put(self, data: dict) -> bool:
+        event_id = None
+        if self.persist:
+            try:
+                event_id = await db.insert(
+                    'INSERT INTO webhook_events (payload, owner, claimed_at) VALUES (%s, %s, NOW())',
+                    (json.dumps(data, ensure_ascii=False), self.owner)
                 )
-                execute_query(
-                    '''
-                    DELETE n
-                    FROM notifications n
-                    LEFT JOIN (
-                        SELECT id
-                        FROM notifications
-                        WHERE user_id = %s
-                        ORDER BY timestamp DESC
-                        LIMIT 100
-                    ) AS keep ON n.id = keep.id
-                    WHERE n.user_id = %s
-                    AND keep.id IS NULL
-                    ''', (user_id, user_id))
-                logging.info(f"Отправлено уведомление о смене исполнителя для {issue_key} пользователю {user_id}")
+            except Exception as e:
+                logging.error(f"Не удалось сохранить событие webhook, обрабатываем без персистентности: {e}")
+            else:
+                self._held.add(event_id)
+        queue = self._partition(data)
+        try:
+            await asyncio.wait_for(queue.put((event_id, 0, data, time.monotonic())), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            # Очередь переполнена: отвечаем ошибкой, чтобы Jira повторила доставку позже
+            self.rejected += 1
+            logging.error(f"Очередь webhook переполнена ({queue.qsize()}), событие отклонено")
+            if event_id is not None:
+                self._held.discard(event_id)
+                await db.execute('DELETE FROM webhook_events WHERE id = %s', (event_id,))
+            return False
+        self.accepted += 1
+        return True
 
+    async def _finish(self, event_id: int, attempts: int, error: Exception | None):
+        if error is None:
+            await db.execute('DELETE FROM webhook_events WHERE id = %s AND owner = %s', (event_id, self.owner))
+        elif attempts + 1 >= self.max_attempts:
+            self.dropped += 1
+            logging.error(f"Событие webhook {event_id} отброшено после {attempts + 1} попыток: {error}")
+            await db.execute('DELETE FROM webhook_events WHERE id = %s AND owner = %s', (event_id, self.owner))
         else:
-            logging.info(f"Неизвестное событие: {event}")
+            # Строка остаётся в таблице без владельца и будет обработана повторно при следующем захвате
+            await db.execute(
+                'UPDATE webhook_events SET owner = NULL, attempts = attempts + 1 WHERE id = %s AND owner = %s',
+                (event_id, self.owner)
+            )
+
+    async def _worker(self, number: int):
+        queue = self.queues[number]
+        while True:
+            event_id, attempts, data, received_at = await queue.get()
+            started = time.monotonic()
+            self.lag.observe(started - received_at)
+            error = None
+            try:
+                await self.handler(data)
+                self.processed += 1
+            except Exception as e:
+                error = e
+                self.failed += 1
+                logging.error(f"Ошибка обработки webhook воркером {number}: {e}")
+            finally:
+                self.processing_time.observe(time.monotonic() - started)
+                queue.task_done()
+            if event_id is not None:
+                try:
+                    await self._finish(event_id, attempts, error)
+                except Exception as e:
+                    logging.error(f"Не удалось сохранить результат обработки события webhook {event_id}: {e}")
+                finally:
+                    self._held.discard(event_id)
+
+    async def _claim(self):
+        # Продлеваем свои строки, затем забираем ничьи и зависшие у остановившихся реплик
+        await db.execute('UPDATE webhook_events SET claimed_at = NOW() WHERE owner = %s', (self.owner,))
+        claimed = await db.execute('''
+            UPDATE webhook_events
+            SET owner = %s, claimed_at = NOW()
+            WHERE owner IS NULL OR claimed_at IS NULL OR claimed_at < DATE_SUB(NOW(), INTERVAL %s SECOND)
+        ''', (self.owner, self.claim_timeout))
+        if not claimed:
+            return
+        rows = await db.fetch('SELECT id, attempts, payload FROM webhook_events WHERE owner = %s ORDER BY id ASC', (self.owner,))
+        # Свои строки, уже стоящие в очереди или в обработке, повторно не ставим
+        rows = [row for row in rows if row[0] not in self._held]
+        if rows:
+            self.restored += len(rows)
+            logging.info(f"Забрано необработанных событий webhook: {len(rows)}")
+        for event_id, attempts, payload in rows:
+            self._held.add(event_id)
+            data = json.loads(payload)
+            await self._partition(data).put((event_id, attempts, data, time.monotonic()))
+
+    async def _claim_loop(self):
+        while True:
+            try:
+                await self._claim()
+            except Exception as e:
+                logging.error(f"Ошибка захвата событий webhook: {e}")
+            await asyncio.sleep(max(self.claim_timeout / 3, 1))
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker(number)) for number in range(self.workers)]
+        if self.persist:
+            self._claim_task = asyncio.create_task(self._claim_loop())
+
+    async def stop(self):
+        if self._claim_task:
+            self._claim_task.cancel()
+        # Новые события уже не принимаются: даём воркерам обработать принятые, на которые Jira получила 200
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), self.drain_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Остановка с необработанными событиями webhook: {self.depth()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.persist:
+            # Оставшиеся строки сразу отдаём другим репликам, не дожидаясь claim_timeout
+            try:
+                await db.execute('UPDATE webhook_events SET owner = NULL WHERE owner = %s', (self.owner,))
+            except Exception as e:
+                logging.error(f"Не удалось освободить события webhook: {e}")
+
+    def depth(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth(),
+            "capacity": sum(queue.maxsize for queue in self.queues),
+            "workers": self.workers,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+            "restored": self.restored,
+            "dropped": self.dropped,
+            "lag": self.lag.snapshot(),
+            "processing_time": self.processing_time.snapshot()
+        }
+
+async def process_webhook_event(data: dict):
+    outbound_lane.set(LANE_BULK)
+    event = data.get('event')
+    if not event:
+        logging.info("Webhook не содержит события")
+        return
+
+    issue_key = data.get('issue_key')
+    if not issue_key:
+        logging.info("Webhook не содержит ключа задачи")
+        return
+
+    result = await db.fetch(
+        'SELECT user_id, status FROM requests WHERE issue_key = %s',
+        (issue_key,)
+    )
+    if not result:
+        logging.info(f"Задача {issue_key} не найдена в базе")
+        return
+    user_id, last_status = result[0]
+
+    issue_state = await resolve_issue_state(issue_key, data) or {}
+    try:
+        await issue_mirror.apply_webhook(issue_key, event, data)
+    except Exception as e:
+        logging.error(f"Ошибка обновления зеркала задачи {issue_key}: {e}")
+
+    if event == 'status_changed':
+        from_status = data.get('status', {}).get('from', 'Неизвестно')
+        to_status = data.get('status', {}).get('to') or issue_state.get('status', 'Неизвестно')
+        if to_status == last_status:
+            logging.info(f"Статус задачи {issue_key} не изменился")
+            return
+        # Условная запись: если сверка статусов уже применила этот переход, уведомление отправила она
+        changed = await db.execute(
+            'UPDATE requests SET status = %s WHERE issue_key = %s AND status <=> %s',
+            (to_status, issue_key, last_status)
+        )
+        if not changed:
+            logging.info(f"Статус задачи {issue_key} уже обновлён сверкой")
+            return
+        if should_notify():
+            message_text = status_change_text(issue_key, from_status, to_status)
+            await notification_coalescer.submit(user_id, issue_key, event, message_text)
+            logging.info(f"Уведомление о смене статуса для {issue_key} пользователю {user_id} передано на отправку")
+    
+    elif event == 'comment_added':
+        initiator = data.get('initiator', 'Неизвестный')
+        initiator_displayName = data.get('initiator_displayName', 'Неизвестный')
+        comment = data.get('comment', 'Нет текста')
+        if initiator != 'ortp_bot' and should_notify():
+            message_text = f"💁‍♀️ Новый комментарий к вашей заявке 🔑{issue_key} от 👩‍💼 {initiator_displayName}: {comment}. " + comment_reply_hint(issue_key)
+            await notification_coalescer.submit(user_id, issue_key, event, message_text)
+            logging.info(f"Уведомление о новом комментарии для {issue_key} пользователю {user_id} передано на отправку")
+    
+    elif event == 'assignee_changed':
+        from_assignee = data.get('assignee', {}).get('from', 'Не назначен')
+        to_assignee = data.get('assignee', {}).get('to', 'Не назначен') or 'Не назначен'
+        if should_notify():
+            message_text = f"👩‍💼 Новый исполнитель вашей заявки 🔑{issue_key} - 🙋‍♀️ {to_assignee}"
+            await notification_coalescer.submit(user_id, issue_key, event, message_text)
+            logging.info(f"Уведомление о смене исполнителя для {issue_key} пользователю {user_id} передано на отправку")
+
+    else:
+        logging.info(f"Неизвестное событие: {event}")
+
+webhook_queue = WebhookQueue(
+    process_webhook_event,
+    maxsize=WEBHOOK_QUEUE_SIZE,
+    workers=WEBHOOK_WORKERS,
+    enqueue_timeout=WEBHOOK_ENQUEUE_TIMEOUT,
+    persist=WEBHOOK_QUEUE_PERSIST,
+    drain_timeout=WEBHOOK_DRAIN_TIMEOUT,
+    claim_timeout=WEBHOOK_CLAIM_TIMEOUT,
+    max_attempts=WEBHOOK_MAX_ATTEMPTS
+)
+
+async def jira_webhook_handler(request: web.Request):
+    try:
+        secret = WEBHOOK_SECRET.encode('utf-8')
+        signature = request.headers.get('X-Hub-Signature')
+        if signature:
+            method, signature = signature.split('=')
+            body = await request.read()
+            expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+            logging.info(f"Signature: {signature}, Expected: {expected}")
+            if not hmac.compare_digest(signature, expected):
+                logging.error("Неверная подпись webhook")
+                return web.Response(status=401)
         
-        return web.Response(status=200)
+        data = await request.json()
+        logging.info(f"Получен webhook: {data}")
     except Exception as e:
         logging.error(f"Ошибка в webhook handler: {e}")
         return web.Response(status=500)
 
+    # Обработка идёт в фоне: Jira получает ответ сразу и не ретраит при массовых переходах
+    if not await webhook_queue.put(data):
+        return web.Response(status=503)
+    return web.Response(status=200)
+
+def collect_metrics() -> dict:
+    return {
+        "db": db.stats(),
+        "priority_cache": priority_cache.stats(),
+        "webhook_queue": webhook_queue.stats(),
+        "issue_state_cache": issue_state_cache.stats(),
+        "issue_mirror": issue_mirror.stats(),
+        "status_sync": status_sync.stats(),
+        "ticket_outbox": ticket_outbox.stats(),
+        "jira": jira_client.stats(),
+        "telegram_outbound": outbound.stats(),
+        "notification_digest": notification_coalescer.stats(),
+        "notification_retention": notification_retention.stats(),
+        "verified_users": verified_users.stats(),
+        "mail": mail_sender.stats(),
+        "media_downloads": media_downloads.stats(),
+        "albums": album_middleware.stats(),
+        "team_roster": team_roster.stats(),
+        "fsm_storage": fsm_storage.stats() if isinstance(fsm_storage, MySQLStorage) else {}
+    }
+
+async def metrics_handler(request: web.Request):
+    return web.json_response(collect_metrics())
+
 async def main():
     logging.info("🤖 Бот запущен")
+    await db.connect()
+    pending = await pending_migrations()
+    if pending and DB_AUTO_MIGRATE:
+        await run_migrations()
+    elif pending:
+        await db.close()
+        raise SystemExit(f"Схема БД устарела, не применены миграции {[version for version, _, _ in pending]}. Запустите: python bot_next_gen_11.py migrate")
+    await priority_cache.start()
+    await webhook_queue.start()
+    notification_retention.start()
+    notification_coalescer.start()
+    issue_mirror.start()
+    status_sync.start()
+    ticket_outbox.start()
+    if isinstance(fsm_storage, MySQLStorage):
+        fsm_storage.start()
     app = web.Application()
-    app.add_routes([web.post(WEBHOOK_PATH, jira_webhook_handler)])
+    app.add_routes([
+        web.post(WEBHOOK_PATH, jira_webhook_handler),
+        web.get(METRICS_PATH, metrics_handler)
+    ])
+    if TELEGRAM_UPDATES_MODE == "webhook":
+        if not TELEGRAM_WEBHOOK_URL or not TELEGRAM_WEBHOOK_SECRET:
+            await db.close()
+            raise SystemExit("Для TELEGRAM_UPDATES_MODE=webhook нужны TELEGRAM_WEBHOOK_URL и TELEGRAM_WEBHOOK_SECRET")
+        # Апдейты обрабатываются в фоне: Telegram сразу получает 200, заголовок с секретом проверяется обработчиком
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            handle_in_background=True,
+            secret_token=TELEGRAM_WEBHOOK_SECRET
+        ).register(app, path=TELEGRAM_WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, WEBHOOK_SERVER_HOST, WEBHOOK_SERVER_PORT)
     await site.start()
     logging.info(f"Webhook сервер запущен на {WEBHOOK_SERVER_HOST}:{WEBHOOK_SERVER_PORT}")
-    await dp.start_polling(bot)
+    try:
+        if TELEGRAM_UPDATES_MODE == "webhook":
+            await bot.set_webhook(
+                url=TELEGRAM_WEBHOOK_URL,
+                secret_token=TELEGRAM_WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=TELEGRAM_WEBHOOK_MAX_CONNECTIONS
+            )
+            logging.info(f"Telegram webhook установлен: {TELEGRAM_WEBHOOK_URL}")
+            # Вебхук не снимается при остановке: его продолжают обслуживать другие реплики.
+            # По SIGTERM/SIGINT (docker stop) выходим штатно, чтобы finally сохранил и освободил фоновые очереди
+            stop_event = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, stop_event.set)
+            await stop_event.wait()
+            logging.info("Получен сигнал остановки")
+        else:
+            # getUpdates не работает, пока установлен вебхук, поэтому при возврате к polling снимаем его
+            await bot.delete_webhook()
+            await dp.start_polling(bot, handle_as_tasks=True, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        await runner.cleanup()
+        await ticket_outbox.stop()
+        await webhook_queue.stop()
+        await notification_coalescer.stop()
+        await notification_retention.stop()
+        await issue_mirror.stop()
+        await status_sync.stop()
+        await mail_sender.stop()
+        await media_downloads.stop()
+        await priority_cache.stop()
+        await outbound.stop()
+        await jira_client.close()
+        # Dispatcher закрывает хранилище на своём shutdown, но несброшенные изменения FSM
+        # должны гарантированно уйти в базу до закрытия пула
+        if isinstance(fsm_storage, MySQLStorage):
+            await fsm_storage.close()
+        await db.close()
+
+async def migrate(explain: bool):
+    await db.connect()
+    try:
+        if explain:
+            print_plans("EXPLAIN до миграций", await explain_hot_queries())
+        await run_migrations()
+        if explain:
+            print_plans("EXPLAIN после миграций", await explain_hot_queries())
+        logging.info("Схема БД актуальна")
+    finally:
+        await db.close()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    command = sys.argv[1] if len(sys.argv) > 1 else "run"
+    if command == "migrate":
+        asyncio.run(migrate(explain="--explain" in sys.argv))
+    else:
+        asyncio.run(main())